@@ -0,0 +1,185 @@
+"""
+NPC Builder benchmarks
+Purpose: Measures the database, generation, PDF and S3 paths of npc_builder.py
+against local stand-ins for DynamoDB and S3 (moto), so runs are repeatable and
+cost nothing. Reports latency percentiles, throughput and AWS calls per operation.
+Usage: python npc_benchmark.py [--quick] [--json results.json] [--baseline results.json]
+"""
+import os
+import sys
+import io
+import json
+import time
+import tempfile
+import argparse
+import contextlib
+from collections import Counter
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# moto answers boto3 calls locally, these keep boto3 from looking for real credentials
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+# AWS CALL COUNTER
+_aws_calls = Counter()
+
+def count_aws_calls():
+    """ counts every API call botocore makes, split by service and operation """
+    from botocore.client import BaseClient
+    make_api_call = BaseClient._make_api_call
+
+    def counted_api_call(client, operation_name, api_params):
+        _aws_calls[client.meta.service_model.service_name + '.' + operation_name] += 1
+        return make_api_call(client, operation_name, api_params)
+
+    BaseClient._make_api_call = counted_api_call
+
+# TIMING
+MIN_BASELINE_SAMPLES = 5 # benchmarks with fewer samples are too noisy to gate on
+def percentile(samples, fraction):
+    """ nearest-rank percentile of a sorted list """
+    index = min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))
+    return samples[index]
+
+def measure(name, operation, iterations, items_per_call=1, setup=None):
+    """ runs operation repeatedly and summarizes its latency, throughput and AWS calls """
+    # setup runs before each call and is left out of the timings and call counts
+    samples = []
+    calls = Counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            if setup:
+                setup()
+            _aws_calls.clear()
+            call_start = time.perf_counter()
+            operation()
+            samples.append(time.perf_counter() - call_start)
+            calls.update(_aws_calls)
+    total = sum(samples)
+    samples.sort()
+    return {
+        'name': name,
+        'iterations': iterations,
+        'items': iterations * items_per_call,
+        'p50_ms': percentile(samples, 0.50) * 1000,
+        'p95_ms': percentile(samples, 0.95) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'items_per_sec': iterations * items_per_call / max(total, 1e-9),
+        'aws_calls': sum(calls.values()),
+        'aws_calls_per_item': sum(calls.values()) / (iterations * items_per_call),
+        'aws_operations': dict(calls)
+    }
+
+# BENCHMARKS
+def run_benchmarks(quick=False):
+    """ builds a fake AWS environment, then times each path of the builder """
+    import npc_builder as nb
+    scale = 1 if quick else 10
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        nb.create_db()
+        nb.create_bucket()
+    table = nb.get_dynamodb().Table('trait')
+    results.append(measure('count_items_db', lambda: nb.count_items_db(table), 20 * scale))
+
+    def load_catalogs():
+        nb.refresh_catalog()
+        nb.preload_catalogs()
+    results.append(measure('catalog load (all tables)', load_catalogs, 3 * scale))
+    results.append(measure('get_random_name', lambda: nb.get_random_name('Female'),
+                           200 * scale))
+
+    results.append(measure('random character (menu)', nb.get_random_character, 100 * scale))
+    batch = 1000 * scale
+    results.append(measure('generate_characters', lambda: list(nb.generate_characters(batch)),
+                           5, items_per_call=batch))
+    results.append(measure('populate_db (trait)', lambda: nb.populate_db('trait'),
+                           MIN_BASELINE_SAMPLES, items_per_call=nb.catalog_count('trait')))
+    characters = list(nb.generate_characters(50 * scale, seed=1))
+    sheets = iter(characters * 2)
+
+    def render_sheet():
+        character = next(sheets)
+        descriptions = nb.resolve_descriptions([character])[0]
+        return nb.pdf_bytes(nb.build_character_pdf(**character, **descriptions))
+    results.append(measure('save_character render', render_sheet, len(characters)))
+    data = render_sheet()
+    keys = iter(range(10 ** 9))
+    results.append(measure('S3 upload', lambda: nb.upload_bytes(data, f'bench-{next(keys)}.pdf'),
+                           20 * scale))
+    results.append(measure('S3 list (full refresh)', lambda: nb.refresh_manifest(force=True),
+                           5))
+    purge_size = 20 * scale
+
+    def fill_bucket():
+        for _ in range(purge_size):
+            nb.upload_bytes(data, f'bench-{next(keys)}.pdf')
+    results.append(measure('S3 delete all', nb.empty_bucket, MIN_BASELINE_SAMPLES,
+                           items_per_call=purge_size, setup=fill_bucket))
+    return results
+
+def print_results(results):
+    """ prints one row per benchmark """
+    print(f"{'benchmark':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'items/sec':>12}{'AWS/item':>10}")
+    for result in results:
+        print(f"{result['name']:<28}{result['p50_ms']:>10.3f}{result['p95_ms']:>10.3f}"
+              f"{result['p99_ms']:>10.3f}{result['items_per_sec']:>12.0f}"
+              f"{result['aws_calls_per_item']:>10.2f}")
+
+def compare_results(results, baseline_file, tolerance):
+    """ returns the benchmarks whose p50 got slower than the saved baseline allows """
+    with open(baseline_file, encoding='utf-8') as json_file:
+        baseline = {result['name']: result for result in json.load(json_file)}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if min(result['iterations'], (previous or result)['iterations']) < MIN_BASELINE_SAMPLES:
+            continue
+        if previous and result['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{result['name']}: p50 {previous['p50_ms']:.3f} ms -> "
+                               f"{result['p50_ms']:.3f} ms")
+    return regressions
+
+def main():
+    """ Benchmark entry point """
+    parser = argparse.ArgumentParser(description='NPC Builder benchmarks')
+    parser.add_argument('--quick', action='store_true', help='fewer iterations')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='fail if a p50 is slower than in this earlier --json file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p50 slowdown against the baseline (default 0.25)')
+    args = parser.parse_args()
+    args.json = args.json and os.path.abspath(args.json)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The benchmarks need moto: pip install "moto[dynamodb,s3]"')
+    # npc_builder expects to run next to a NapierHomework4 folder holding DB-Data
+    work_dir = tempfile.mkdtemp(prefix='npc-benchmark-')
+    os.makedirs(os.path.join(work_dir, 'NapierHomework4'))
+    os.symlink(os.path.join(REPO_DIR, 'DB-Data'),
+               os.path.join(work_dir, 'NapierHomework4', 'DB-Data'))
+    os.chdir(work_dir)
+    sys.path.insert(0, REPO_DIR)
+    count_aws_calls()
+    with mock_aws():
+        results = run_benchmarks(quick=args.quick)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(results, json_file, indent=2)
+    if args.baseline:
+        regressions = compare_results(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\n!!!! REGRESSION !!!!")
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print("\n*** NO REGRESSIONS ***")
+
+if __name__ == '__main__':
+    main()
@@ -7,41 +7,258 @@ Purpose: The NPC Builder is a tool to help create Non-Playable Characters (NPCs)
 for fantasy writing or games like Dungeons and Dragons.
 """
 import logging
+import abc
+import argparse
+import csv
 import json
 import time
 import decimal
 import random
+import hashlib
 import textwrap
+import functools
+import collections
 import sys
-import boto3
+import io
+import base64
+import os
+import mmap
+import struct
+import threading
+import atexit
+import asyncio
+import contextlib
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, wait,
+                                as_completed, FIRST_COMPLETED)
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
-from fpdf import FPDF
 from datetime import datetime
 
 # CONFIGURE AWS BOTO3
-boto3.setup_default_session()
+# boto3 and its clients are slow to import and build, so they are created on first use
 REGION='us-east-1'
 TABLE_NAMES = {"class_type", "gender", "first_name", "family_name", "profession",
                 "quirk", "race", "trait"}
-dynamodb = boto3.resource('dynamodb', region_name = REGION)
-s3 = boto3.client('s3', region_name = REGION)
 BUCKET_NAME='npc-builder-amy-napier-sdev-400-4380'
+METADATA_TABLE = 'catalog_metadata'
+CATALOG_SYNC_VERSION = 2 # bump to make the next sync rewrite every table
+# one record per saved character sheet, keyed on its S3 key and indexed for searches
+CHARACTER_TABLE = 'saved_characters'
+CHARACTER_INDEXES = ['race', 'class_type', 'profession']
+DATA_DIR = './NapierHomework4/DB-Data/'
+# JSON fields for each table and the DynamoDB attributes they are stored as
+CATALOG_FIELDS = {
+    'class_type': {'Class': 'class_type', 'Description': 'class_description',
+                   'PrimaryStat': 'primary_stat'},
+    'gender': {'Gender': 'gender'},
+    'first_name': {'FirstName': 'first_name', 'NameGender': 'name_gender'},
+    'family_name': {'FamilyName': 'family_name', 'NameGender': 'name_gender'},
+    'profession': {'Profession': 'profession', 'Description': 'profession_description',
+                   'Toolkit': 'toolkit'},
+    'quirk': {'Quirk': 'quirk'},
+    'race': {'Race': 'race', 'Description': 'race_description'},
+    'trait': {'Trait': 'trait'}
+}
+_clients = {}
+_clients_lock = threading.RLock()
+_thread_local = threading.local()
+
+def get_session():
+    """ one boto3 session, so its service models are only loaded once """
+    with _clients_lock:
+        if 'session' not in _clients:
+            import boto3
+            _clients['session'] = boto3.session.Session()
+        return _clients['session']
+
+def get_dynamodb():
+    """ boto3 resources are not thread safe, so worker threads each get their own """
+    if threading.current_thread() is threading.main_thread():
+        with _clients_lock:
+            if 'dynamodb' not in _clients:
+                _clients['dynamodb'] = get_session().resource('dynamodb', region_name = REGION)
+                register_metrics(_clients['dynamodb'].meta.client)
+            return _clients['dynamodb']
+    if not hasattr(_thread_local, 'dynamodb'):
+        # built from the shared session under the lock, a new session per thread
+        # would reload every service model
+        with _clients_lock:
+            _thread_local.dynamodb = get_session().resource('dynamodb', region_name = REGION)
+        register_metrics(_thread_local.dynamodb.meta.client)
+    return _thread_local.dynamodb
+
+def get_dynamodb_client():
+    """ low-level DynamoDB client, thread safe and free of the resource's type conversions """
+    with _clients_lock:
+        if 'dynamodb_client' not in _clients:
+            _clients['dynamodb_client'] = register_metrics(
+                get_session().client('dynamodb', region_name = REGION))
+        return _clients['dynamodb_client']
+
+def get_s3():
+    """ the S3 client is thread safe, so one is shared by every thread """
+    with _clients_lock:
+        if 's3' not in _clients:
+            from botocore.config import Config
+            # enough pooled connections for every transfer thread
+            _clients['s3'] = register_metrics(get_session().client('s3', region_name = REGION, config=Config(
+                max_pool_connections=TRANSFER_WORKERS * TRANSFER_PART_CONCURRENCY)))
+        return _clients['s3']
+
+# CONFIGURE CATALOG CACHE
+CATALOG_TTL = 300 # seconds before a cached table is reloaded from its backend
+# 'dynamodb' reads the AWS tables, 'local' reads the DB-Data json files and 'binary'
+# reads the file written by --compile-catalogs
+CATALOG_BACKEND = os.environ.get('NPC_CATALOG_BACKEND', 'dynamodb')
+_catalog_backend = None
+_catalog = {}
+
+# CONFIGURE RANDOM NUMBERS
+# every random pick takes an optional generator, this one is used when none is given
+_rng = random.Random()
+
+def make_rng(seed=None):
+    """ creates an independent generator, seeded when the run should be repeatable """
+    return random.Random(seed)
+
+def spawn_seed(seed, stream):
+    """ derives the seed of an independent child stream from a parent seed """
+    digest = hashlib.blake2b(f'{seed}:{stream}'.encode(), digest_size=16).digest()
+    return int.from_bytes(digest, 'big')
+
+def seed_random(seed):
+    """ reseeds the default generator used by the menu """
+    _rng.seed(seed)
 
 # CONFIGURE LOGGING
-logging.basicConfig(filename='./NapierHomework4/npc_builder.log',
+# delay opens the log file on the first message instead of at import
+logging.basicConfig(handlers=[logging.FileHandler('./NapierHomework4/npc_builder.log',
+                                                  mode='w', delay=True)],
                     level=logging.INFO,
-                    format='%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s',
-                    filemode='w')
+                    format='%(asctime)s %(levelname)s %(module)s %(funcName)s %(message)s')
+
+# CONFIGURE METRICS
+# every AWS call and generation step is timed; when a metrics file is set the totals are
+# written there at exit, as Prometheus text for a .prom file and JSON otherwise
+METRICS_FILE = os.environ.get('NPC_METRICS_FILE')
+_metrics = {} # (kind, service, operation, resource) -> [count, errors, seconds, max seconds]
+_metrics_lock = threading.Lock()
+
+def record_metric(kind, service, operation, resource, seconds, error=False):
+    """ adds one timed call to the running totals """
+    key = (kind, service, operation, resource or '')
+    with _metrics_lock:
+        totals = _metrics.setdefault(key, [0, 0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += bool(error)
+        totals[2] += seconds
+        totals[3] = max(totals[3], seconds)
+
+@contextlib.contextmanager
+def timed(step, resource=None):
+    """ times a generation step, e.g. with timed('populate_db', table_name): """
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record_metric('step', 'npc_builder', step, resource, time.perf_counter() - start, error)
+
+def start_aws_timer(params, model, context, **kwargs):
+    """ botocore hook: notes the table or bucket and start time of an API call """
+    resource = params.get('TableName') or params.get('Bucket')
+    if resource is None and 'RequestItems' in params:
+        resource = ','.join(sorted(params['RequestItems']))
+    context['metrics'] = (model.service_model.service_name, model.name, resource,
+                          time.perf_counter())
+
+def stop_aws_timer(context, parsed=None, exception=None, **kwargs):
+    """ botocore hook: records an API call once its response or error arrives """
+    if 'metrics' in context:
+        service, operation, resource, start = context.pop('metrics')
+        error = exception is not None or 'Error' in (parsed or {})
+        record_metric('aws', service, operation, resource, time.perf_counter() - start, error)
+
+def register_metrics(client):
+    """ times every call a boto3 client makes, retries included """
+    client.meta.events.register('before-parameter-build', start_aws_timer)
+    client.meta.events.register('after-call', stop_aws_timer)
+    client.meta.events.register('after-call-error', stop_aws_timer)
+    return client
+
+def metrics_snapshot():
+    """ the totals so far, one dict per kind, service, operation and resource """
+    with _metrics_lock:
+        return [{'kind': kind, 'service': service, 'operation': operation,
+                 'resource': resource, 'count': count, 'errors': errors,
+                 'seconds': seconds, 'max_seconds': max_seconds}
+                for (kind, service, operation, resource), (count, errors, seconds, max_seconds)
+                in sorted(_metrics.items())]
+
+def metrics_prometheus(snapshot):
+    """ formats a snapshot in the Prometheus text exposition format """
+    lines = []
+    for name, kind, help_text in (('npc_aws_call', 'aws', 'AWS API calls'),
+                                  ('npc_step', 'step', 'NPC Builder steps')):
+        lines += [f'# HELP {name}_seconds {help_text}',
+                  f'# TYPE {name}_seconds summary']
+        errors = []
+        for metric in snapshot:
+            if metric['kind'] != kind:
+                continue
+            labels = (f'service="{metric["service"]}",operation="{metric["operation"]}",'
+                      f'resource="{metric["resource"]}"')
+            lines.append(f'{name}_seconds_count{{{labels}}} {metric["count"]}')
+            lines.append(f'{name}_seconds_sum{{{labels}}} {metric["seconds"]:.6f}')
+            errors.append(f'{name}_errors_total{{{labels}}} {metric["errors"]}')
+        lines += [f'# HELP {name}_errors_total {help_text} that failed',
+                  f'# TYPE {name}_errors_total counter'] + errors
+    return '\n'.join(lines) + '\n'
+
+def export_metrics(path=None):
+    """ writes the metrics summary, called at exit when a metrics file is set """
+    path = path or METRICS_FILE
+    if not path:
+        return
+    snapshot = metrics_snapshot()
+    with open(path, 'w', encoding='utf-8') as metrics_file:
+        if path.endswith('.prom'):
+            metrics_file.write(metrics_prometheus(snapshot))
+        else:
+            json.dump(snapshot, metrics_file, indent=2)
+
+def set_metrics_file(path):
+    """ chooses the file the metrics summary is written to at exit """
+    global METRICS_FILE
+    METRICS_FILE = path
+
+atexit.register(export_metrics)
 
 # CONFIGURE PDF
-class PDF(FPDF):
-    def header(self):
-        self.set_font('Times', 'I', 12)
-        # Title
-        self.cell(30, 10, 'NPC Builder')
-        # Line break
-        self.ln(20)
+SAVE_LOCAL_COPY = True # save_character also writes the PDF to the working directory,
+                       # set from --keep-local or --no-keep-local
+# fpdf is imported by load_fpdf() the first time a PDF is built
+FPDF = None
+PDF = None
+
+def load_fpdf():
+    """ imports fpdf and defines the PDF class on first use """
+    global FPDF, PDF
+    if FPDF is None:
+        from fpdf import FPDF as fpdf_class
+
+        class NPCBuilderPDF(fpdf_class):
+            def header(self):
+                self.set_font('Times', 'I', 12)
+                # Title
+                self.cell(30, 10, 'NPC Builder')
+                # Line break
+                self.ln(20)
+
+        FPDF, PDF = fpdf_class, NPCBuilderPDF
+    return FPDF
 
 # FOR ALL USER YES/NO QUESTIONS
 def user_continue_option():
@@ -78,258 +295,897 @@ def user_number_choice(max_num):
             print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
 
 # INITIALIZE TABLES
-def create_db():
+def create_db(table_names=None):
     """ Create courses DB and populates with items from json file """
-    for table_name in TABLE_NAMES:
-        print(f'Initializing the {table_name} table...')
+    _env_checks.pop('tables', None)
+    print(f'Initializing the {METADATA_TABLE} table...')
+    create_metadata_table()
+    print(f'Initializing the {CHARACTER_TABLE} table...')
+    create_character_table()
+    # only the catalog tables asked for are set up, all of them by default
+    table_names = sorted(TABLE_NAMES if table_names is None
+                         else TABLE_NAMES.intersection(table_names))
+    if not table_names:
+        return
+    # every table is created, waited on and seeded in its own worker
+    with ThreadPoolExecutor(max_workers=len(table_names)) as executor:
+        results = list(executor.map(initialize_table, table_names))
+    print("\n************************ SEED SUMMARY *************************")
+    for table_name, rows, seconds in results:
+        if rows:
+            print(f'*  {table_name:<12} {rows:>6} rows {rows / max(seconds, 0.001):>10.0f} rows/sec')
+        else:
+            print(f'*  {table_name:<12} up to date')
+    print("***************************************************************\n")
+
+def initialize_table(table_name):
+    """ Creates a table if needed, waits for it and fills it from its json file """
+    print(f'Initializing the {table_name} table...')
+    resource = get_dynamodb()
+    table = resource.Table(table_name)
+    try:
+        item_count = count_items_db(table)
+        # an empty table has nothing to diff against
+        incremental = item_count > 0
+        if table.table_status == 'ACTIVE':
+            if item_count > 0:
+                print(f'Table already exists and has {item_count} records, syncing changes...')
+            else:
+                print(f'The {table_name} table was already initialized, populating table...')
+    except ClientError as error:
+        # neither has a new table, whatever the metadata says
+        incremental = False
+        try:
+            table = create_table(resource, table_name)
+        except ClientError as err:
+            logging.error(err)
+            print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            print(error)
+            print(f'Could not create {table_name}.')
+            print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+            return table_name, 0, 0
+    print(f'Making sure the {table_name} table is ready...')
+    table.wait_until_exists()
+    print(f'Attempting to populate the {table_name} table...')
+    return populate_db(table_name, incremental)
+
+def create_table(resource, table_name):
+    """ Creates a catalog table keyed on <table>_id with an index on its value """
+    return resource.create_table(
+        TableName=table_name,
+        KeySchema=[
+            {
+                'AttributeName': table_name + '_id',
+                'KeyType': 'HASH'  #Partition key
+            }
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                'IndexName': table_name + '_index',
+                'KeySchema': [
+                    {
+                    'AttributeName': table_name,
+                    'KeyType': 'HASH'
+                    }
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL',
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 123,
+                    'WriteCapacityUnits': 123
+                }
+            }
+        ],
+        AttributeDefinitions=[
+            {
+                'AttributeName': table_name + '_id',
+                'AttributeType': 'N'
+            },
+            {
+                'AttributeName': table_name,
+                'AttributeType': 'S'
+            }
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 10,
+            'WriteCapacityUnits': 10
+        }
+    )
+
+def build_items(table_name, data):
+    """ Turns the rows of a json file into DynamoDB items numbered from 1 """
+    fields = CATALOG_FIELDS[table_name]
+    items = []
+    for item_id, row in enumerate(data, start=1):
+        item = {table_name + '_id': item_id}
+        for json_field, attribute in fields.items():
+            item[attribute] = row[json_field]
+        items.append(item)
+    return items
+
+def populate_db(table_name, incremental=False):
+    """ Fills a table from its Json file, or with incremental only writes what changed """
+    with timed('populate_db', table_name):
         try:
-            table = dynamodb.Table(table_name)
+            table = get_dynamodb().Table(table_name)
+            marker = get_sync_marker(table_name) if incremental else {}
+            source_hash = catalog_source_hash(table_name)
+            if marker.get('source_hash') == source_hash:
+                print(f"The {table_name} table is already up to date")
+                return table_name, 0, 0
+            items = LocalCatalog().load_rows(table_name)
+            old_hashes = marker.get('row_hashes')
+            # without a marker the rows already in the table are unknown, so every id past
+            # the new end of the file is cleared; ids run from 1, so the live count is the
+            # highest id the table holds
+            old_count = (len(old_hashes) if old_hashes is not None
+                         else scan_count_items(table_name))
+            changed, removed, hashes = diff_rows(table_name, items, old_hashes or [],
+                                                 old_count)
+            start = time.perf_counter()
+            # batch_writer sends 25 item BatchWriteItem requests and resends unprocessed items
+            with table.batch_writer(overwrite_by_pkeys=[table_name + '_id']) as batch:
+                for item in changed:
+                    batch.put_item(Item=item)
+                for item_id in removed:
+                    batch.delete_item(Key={table_name + '_id': item_id})
+            seconds = time.perf_counter() - start
+            set_sync_marker(table_name, len(items), source_hash, hashes)
+            refresh_catalog(table_name)
             item_count = count_items_db(table)
-            if table.table_status == 'ACTIVE':
-                if item_count > 0:
-                    logging.error('Attempted to create %s table, but it already exists', table_name)
-                    print(f'Table already exists and has {item_count} records.')
-                else:
-                    print(f'The {table_name} table was already initialized, populating table...')
-                    populate_db(table_name)
+            writes = len(changed) + len(removed)
+            rate = writes / max(seconds, 0.001)
+            logging.info('The %s table synced to %s records in %.2fs: %s written, %s removed',
+                         table_name, item_count, seconds, len(changed), len(removed))
+            print("\n************************ SUCCESS ******************************")
+            print(f"The {table_name} table initialized with {item_count} records")
+            print(f"Wrote {len(changed)} and removed {len(removed)} rows in {seconds:.2f}s "
+                  f"({rate:.0f} rows/sec)")
+            print("***************************************************************\n")
+            return table_name, writes, seconds
         except ClientError as error:
-            try:
-                table = dynamodb.create_table(
-                    TableName=table_name,
-                    KeySchema=[
-                        {
-                            'AttributeName': table_name + '_id',
-                            'KeyType': 'HASH'  #Partition key
-                        }
-                    ],
-                    GlobalSecondaryIndexes=[
-                        {
-                            'IndexName': table_name + '_index',
-                            'KeySchema': [
-                                {
-                                'AttributeName': table_name,
-                                'KeyType': 'HASH'
-                                }
-                            ],
-                            'Projection': {
-                                'ProjectionType': 'ALL',
-                            },
-                            'ProvisionedThroughput': {
-                                'ReadCapacityUnits': 123,
-                                'WriteCapacityUnits': 123
-                            }
-                        }
-                    ],
-                    AttributeDefinitions=[
-                        {
-                            'AttributeName': table_name + '_id',
-                            'AttributeType': 'N'
-                        },
+            logging.error(error)
+            print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            print(error)
+            print(f'Could not populate {table_name}.')
+            print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+        return table_name, 0, 0
+
+# COUNT ITEMS IN TABLE
+def count_items_db(table):
+    """ reads the maintained item count for a table (or table name) from the metadata table """
+    # only the shared low-level client is used, so any thread can count
+    table_name = getattr(table, 'name', table)
+    try:
+        response = get_dynamodb_client().get_item(
+            TableName=METADATA_TABLE,
+            Key={'table_name': {'S': table_name}},
+            ProjectionExpression='item_count'
+        )
+        if 'Item' in response:
+            return int(response['Item']['item_count']['N'])
+    except ClientError as error:
+        logging.error(error)
+    # no counter yet, count the table once and remember the result
+    item_count = scan_count_items(table_name)
+    set_item_count(table_name, item_count)
+    return item_count
+
+def scan_count_items(table):
+    """ scans a table (or table name) to determine live number of items """
+    paginator = get_dynamodb_client().get_paginator('scan')
+    return sum(page['Count'] for page in
+               paginator.paginate(TableName=getattr(table, 'name', table), Select='COUNT'))
+
+# TABLE METADATA
+def create_metadata_table():
+    """ creates the table that keeps the item count of every other table """
+    try:
+        table = get_dynamodb().create_table(
+            TableName=METADATA_TABLE,
+            KeySchema=[
+                {
+                    'AttributeName': 'table_name',
+                    'KeyType': 'HASH'  #Partition key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'table_name',
+                    'AttributeType': 'S'
+                }
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 10,
+                'WriteCapacityUnits': 10
+            }
+        )
+        table.wait_until_exists()
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ResourceInUseException':
+            logging.error(err)
+            print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            print(err)
+            print(f'Could not create {METADATA_TABLE}.')
+            print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+
+def set_item_count(table_name, item_count):
+    """ records the number of items a table holds """
+    try:
+        get_dynamodb_client().put_item(
+            TableName=METADATA_TABLE,
+            Item={
+                'table_name': {'S': table_name},
+                'item_count': {'N': str(item_count)}
+            }
+        )
+    except ClientError as error:
+        logging.error(error)
+
+def catalog_source_hash(table_name, data_dir=None):
+    """ fingerprint of a table's json file and of how its fields are stored """
+    digest = hashlib.sha256(json.dumps([CATALOG_SYNC_VERSION, CATALOG_FIELDS[table_name]],
+                                       sort_keys=True).encode())
+    with open(os.path.join(data_dir or DATA_DIR, table_name + '.json'), 'rb') as json_file:
+        digest.update(json_file.read())
+    return digest.hexdigest()
+
+def row_hash(table_name, item):
+    """ short fingerprint of an item's content, stored so later syncs can tell what changed """
+    # the id is left out, so a row that only moved in the json file still matches
+    content = {name: value for name, value in item.items() if name != table_name + '_id'}
+    return hashlib.blake2b(json.dumps(content, sort_keys=True, default=str).encode(),
+                           digest_size=8).hexdigest()
+
+def diff_rows(table_name, items, old_hashes, old_count=0):
+    """ the items to write, the ids to delete and the row hashes by id after a sync """
+    # ids must stay 1..n for the random picks, so unchanged rows keep their old id and new
+    # or edited rows fill the ids that were freed; an insert or removal anywhere in the
+    # file costs a write or two instead of renumbering every row after it
+    key_name = table_name + '_id'
+    count = len(items)
+    old_ids = {}
+    for item_id, old_hash in enumerate(old_hashes[:count], start=1):
+        old_ids.setdefault(old_hash, []).append(item_id)
+    hashes = [None] * count
+    unplaced = []
+    for item in items:
+        item_hash = row_hash(table_name, item)
+        if old_ids.get(item_hash):
+            hashes[old_ids[item_hash].pop(0) - 1] = item_hash
+        else:
+            unplaced.append((item, item_hash))
+    free_ids = [item_id for item_id, item_hash in enumerate(hashes, start=1) if item_hash is None]
+    changed = []
+    for item_id, (item, item_hash) in zip(free_ids, unplaced):
+        hashes[item_id - 1] = item_hash
+        changed.append(dict(item, **{key_name: item_id}))
+    # rows beyond the new end were either removed or moved into a free id
+    return changed, range(count + 1, max(len(old_hashes), old_count) + 1), hashes
+
+def sync_marker_key(table_name):
+    """ metadata key of a table's sync marker, kept apart so item count reads stay small """
+    return table_name + '#sync'
+
+def get_sync_marker(table_name):
+    """ the source and row hashes recorded the last time a table was synced """
+    try:
+        response = get_dynamodb_client().get_item(
+            TableName=METADATA_TABLE,
+            Key={'table_name': {'S': sync_marker_key(table_name)}},
+            ProjectionExpression='sync_version, source_hash, row_hashes'
+        )
+        marker = deserialize_item(response.get('Item', {}))
+        if marker.get('sync_version') == CATALOG_SYNC_VERSION:
+            return marker
+    except ClientError as error:
+        logging.error(error)
+    return {}
+
+def set_sync_marker(table_name, item_count, source_hash, hashes):
+    """ records a table's item count and, separately, what it was synced from """
+    set_item_count(table_name, item_count)
+    try:
+        get_dynamodb().Table(METADATA_TABLE).put_item(
+            Item={
+                'table_name': sync_marker_key(table_name),
+                'sync_version': CATALOG_SYNC_VERSION,
+                'source_hash': source_hash,
+                'row_hashes': hashes
+            }
+        )
+    except ClientError as error:
+        logging.error(error)
+
+# SAVED CHARACTER RECORDS
+CHARACTER_RECORD_BATCH = 100 # records the pipeline collects before writing them
+
+def create_character_table():
+    """ creates the saved character table with an index on each searchable attribute """
+    try:
+        table = get_dynamodb().create_table(
+            TableName=CHARACTER_TABLE,
+            KeySchema=[
+                {
+                    'AttributeName': 'character_id',
+                    'KeyType': 'HASH'  #Partition key
+                }
+            ],
+            GlobalSecondaryIndexes=[
+                {
+                    'IndexName': attribute + '_index',
+                    'KeySchema': [
                         {
-                            'AttributeName': table_name,
-                            'AttributeType': 'S'
+                        'AttributeName': attribute,
+                        'KeyType': 'HASH'
                         }
                     ],
-                    ProvisionedThroughput={
+                    'Projection': {
+                        'ProjectionType': 'ALL',
+                    },
+                    'ProvisionedThroughput': {
                         'ReadCapacityUnits': 10,
                         'WriteCapacityUnits': 10
                     }
-                )
-            except ClientError as err:
-                logging.error(err)
-                print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-                print(error)
-                print(f'Could not create {table_name}.')
-                print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
-    for table_name in TABLE_NAMES:
-        print(f'Making sure the {table_name} table is ready...')
+                } for attribute in CHARACTER_INDEXES
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': attribute,
+                    'AttributeType': 'S'
+                } for attribute in ['character_id'] + CHARACTER_INDEXES
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 10,
+                'WriteCapacityUnits': 10
+            }
+        )
         table.wait_until_exists()
-        print(f'Attempting to populate the {table_name} table...')
-        populate_db(table_name)
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ResourceInUseException':
+            logging.error(err)
+            print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            print(err)
+            print(f'Could not create {CHARACTER_TABLE}.')
+            print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
 
-def populate_db(table_name):
-    """ Fills all of the tables with data from Json files """
+def character_record(character, object_key):
+    """ the saved character item for a character sheet stored under object_key """
+    record = {field: character[field] for field in CHARACTER_FIELDS}
+    record['character_id'] = object_key
+    record['saved_at'] = datetime.now().isoformat(timespec='seconds')
+    return record
+
+def save_character_records(records):
+    """ writes saved character records, 25 to a BatchWriteItem request """
     try:
-        table = dynamodb.Table(table_name)
-        file_name = "./NapierHomework4/DB-Data/" + table_name + ".json"
-        with open(file_name, encoding="utf-8") as json_file:
-            data = json.load(json_file, parse_float = decimal.Decimal)
-            if table_name == 'class_type':
-                class_type_id=0
-                for item in data:
-                    class_type_id += 1
-                    class_type = item['Class']
-                    class_description = item['Description']
-                    primary_stat = item['PrimaryStat']
-                    logging.info('Adding ' + class_type + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'class_type_id': class_type_id,
-                            'class_type': class_type,
-                            'class_description': class_description,
-                            'primary_stat': primary_stat
-                        }
-                    )
-            if table_name == 'gender':
-                gender_id=0
-                for item in data:
-                    gender_id += 1
-                    gender = item['Gender']
-                    logging.info('Adding ' + gender + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'gender_id': gender_id,
-                            'gender': gender,
-                        }
-                    )
-            if table_name == 'first_name':
-                first_name_id=0
-                for item in data:
-                    first_name_id += 1
-                    first_name = item['FirstName']
-                    name_gender = item['NameGender']
-                    logging.info('Adding ' + first_name + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'first_name_id': first_name_id,
-                            'first_name': first_name,
-                            'name_gender': name_gender
-                        }
-                    )
-            if table_name == 'family_name':
-                family_name_id=0
-                for item in data:
-                    family_name_id += 1
-                    family_name = item['FamilyName']
-                    name_gender = item['NameGender']
-                    logging.info('Adding ' + family_name + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'family_name_id': family_name_id,
-                            'family_name': family_name,
-                            'name_gender': name_gender
-                        }
-                    )
-            if table_name == 'profession':
-                prof_id=0
-                for item in data:
-                    prof_id += 1
-                    profession = item['Profession']
-                    prof_description = item['Description']
-                    toolkit = item['Toolkit']
-                    logging.info('Adding ' + profession + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'profession_id': prof_id,
-                            'profession': profession,
-                            'profession_description': prof_description,
-                            'toolkit': toolkit
-                        }
-                    )
-            if table_name == 'quirk':
-                quirk_id=0
-                for item in data:
-                    quirk_id += 1
-                    quirk = item['Quirk']
-                    logging.info('Adding ' + quirk + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'quirk_id': quirk_id,
-                            'quirk': quirk
-                        }
-                    )
-            if table_name == 'race':
-                race_id=0
-                for item in data:
-                    race_id += 1
-                    race = item['Race']
-                    race_description = item['Description']
-                    logging.info('Adding ' + race + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'race_id': race_id,
-                            'race': race,
-                            'race_description': race_description
-                        }
-                    )
-            if table_name == 'trait':
-                trait_id=0
-                for item in data:
-                    trait_id += 1
-                    trait = item['Trait']
-                    logging.info('Adding ' + trait + ' to ' + table_name)
-                    response = table.put_item(
-                        Item={
-                            'trait_id': trait_id,
-                            'trait': trait
-                        }
-                    )
-        item_count = count_items_db(table)
-        logging.info('The %s table initalized with %s records', table_name, item_count)
-        print("\n************************ SUCCESS ******************************")
-        print(f"The {table_name} table initialized with {item_count} records")
-        print("***************************************************************\n")
+        with get_dynamodb().Table(CHARACTER_TABLE).batch_writer(
+                overwrite_by_pkeys=['character_id']) as batch:
+            for record in records:
+                batch.put_item(Item=record)
+        return True
     except ClientError as error:
         logging.error(error)
+        return False
+
+def delete_character_records(object_keys):
+    """ removes the records of character sheets deleted from the bucket """
+    # the shared low-level client is thread safe, so purge threads need no resource of their own
+    client = get_dynamodb_client()
+    object_keys = list(object_keys)
+    try:
+        for start in range(0, len(object_keys), 25):
+            requests = {CHARACTER_TABLE: [
+                {'DeleteRequest': {'Key': {'character_id': {'S': object_key}}}}
+                for object_key in object_keys[start:start + 25]]}
+            for attempt in range(PURGE_RETRIES):
+                requests = client.batch_write_item(RequestItems=requests)['UnprocessedItems']
+                if not requests:
+                    break
+                time.sleep(0.1 * 2 ** attempt)
+            if requests:
+                logging.error('Could not delete %s saved character records',
+                              len(requests[CHARACTER_TABLE]))
+    except ClientError as error:
+        logging.error(error)
+
+def find_characters(race=None, class_type=None, profession=None):
+    """ saved characters matching every given attribute, queried through an index """
+    from boto3.dynamodb.conditions import Key, Attr
+    wanted = {attribute: value for attribute, value in
+              zip(CHARACTER_INDEXES, (race, class_type, profession)) if value is not None}
+    table = get_dynamodb().Table(CHARACTER_TABLE)
+    kwargs = {}
+    if wanted:
+        # the first attribute picks the index, the others filter its matches
+        attribute = next(iter(wanted))
+        kwargs['IndexName'] = attribute + '_index'
+        kwargs['KeyConditionExpression'] = Key(attribute).eq(wanted.pop(attribute))
+    for attribute, value in wanted.items():
+        condition = Attr(attribute).eq(value)
+        kwargs['FilterExpression'] = (kwargs['FilterExpression'] & condition
+                                      if 'FilterExpression' in kwargs else condition)
+    read = table.query if 'IndexName' in kwargs else table.scan
+    characters = []
+    while True:
+        response = read(**kwargs)
+        characters.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    characters.sort(key=lambda record: record['character_id'])
+    return characters
+
+def select_filter(table_name, label):
+    """ asks whether to search by an attribute and returns the chosen value or None """
+    print(f'Would you like to only see characters of one {label}?')
+    if not user_continue_option():
+        return None
+    options = display_table_contents(table_name)
+    return options[user_number_choice(len(options)) - 1]
+
+def find_saved_characters():
+    """ Lists the saved characters that match the user's race, class and profession """
+    race = select_filter('race', 'race')
+    class_type = select_filter('class_type', 'class')
+    profession = select_filter('profession', 'profession')
+    try:
+        characters = find_characters(race, class_type, profession)
+    except ClientError as err:
+        logging.error(err)
         print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        print(error)
-        print(f'Could not populate {table_name}.')
+        print('Cannot search saved characters. Please see log for more info.')
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+        return []
+    if not characters:
+        print('No saved characters match.')
+    for item_number, character in enumerate(characters, start=1):
+        print(f"[{item_number}] {character['name']}, {character['race']} "
+              f"{character['profession']} {character['class_type']}")
+        print(f"    {character['character_id']}")
+    return characters
 
-# COUNT ITEMS IN TABLE
-def count_items_db(table):
-    """ scans table to determine live number of items """
-    response = table.scan()
-    complete = False
-    records=[]
-    scan_kwargs = {}
-    while not complete:
-        try:
-            response = table.scan(**scan_kwargs)
-        except ClientError as error:
-            logging.error(error)
+# CHECK TABLES EXIST
+ENV_CHECK_TTL = 300 # seconds an environment check result is reused
+_env_checks = {}
 
-        records.extend(response.get('Items', []))
-        next_key = response.get('LastEvaluatedKey')
-        scan_kwargs['ExclusiveStartKey'] = next_key
-        complete = True if next_key is None else False
-    item_count = 0
-    for item in records:
-        item_count += 1
-    return item_count
+def cached_check(name, check):
+    """ runs an environment check, reusing a recent result """
+    result = _env_checks.get(name)
+    if result is None or time.time() - result[0] > ENV_CHECK_TTL:
+        result = (time.time(), check())
+        _env_checks[name] = result
+    return result[1]
+
+def check_table(table_name):
+    """ DescribeTable plus the item counter: the table is ACTIVE and has records """
+    # the checks run in parallel, so they share the thread safe low-level client
+    try:
+        table = get_dynamodb_client().describe_table(TableName=table_name)['Table']
+        if table['TableStatus'] != 'ACTIVE':
+            return False
+        # the metadata and saved character tables may be empty
+        if table_name in (METADATA_TABLE, CHARACTER_TABLE):
+            return True
+        # DescribeTable's approximate count is enough to tell the table has records, but
+        # DynamoDB only refreshes it every six hours or so, so a zero is checked against
+        # the maintained counter before the table is treated as empty
+        return table.get('ItemCount', 0) > 0 or count_items_db(table_name) > 0
+    except:
+        return False
+
+def unready_tables():
+    """ the tables that are missing or still empty """
+    def run_checks():
+        table_names = [METADATA_TABLE, CHARACTER_TABLE] + sorted(TABLE_NAMES)
+        with ThreadPoolExecutor(max_workers=len(table_names)) as executor:
+            return [table_name for table_name, ready in
+                    zip(table_names, executor.map(check_table, table_names)) if not ready]
+    return cached_check('tables', run_checks)
 
-# CHECK TABLES EXIST
 def check_tables():
     """ checks if all of the tables exist and have at least 1 record """
-    for table_name in TABLE_NAMES:
+    return not unready_tables()
+
+# CATALOG BACKENDS
+class CatalogBackend(abc.ABC):
+    """ Where the catalog cache reads table rows from """
+    name = None
+
+    @abc.abstractmethod
+    def load_rows(self, table_name):
+        """ returns every row of a table as a dict of DynamoDB attribute names """
+
+def deserialize_item(item):
+    """ reads plain values straight out of a low-level DynamoDB item """
+    record = {}
+    for name, value in item.items():
+        if 'S' in value:
+            record[name] = value['S']
+        elif 'N' in value:
+            number = value['N']
+            record[name] = int(number) if number.lstrip('-').isdigit() else decimal.Decimal(number)
+        else:
+            # lists, maps and sets are rare here, so they go through boto3's full deserializer
+            from boto3.dynamodb.types import TypeDeserializer
+            record[name] = TypeDeserializer().deserialize(value)
+    return record
+
+class DynamoDBCatalog(CatalogBackend):
+    """ Reads catalog tables from DynamoDB """
+    name = 'dynamodb'
+
+    def load_rows(self, table_name):
+        # the low-level client skips boto3's resource layer and its Decimal conversions
+        client = get_dynamodb_client()
+        attributes = [table_name + '_id'] + list(CATALOG_FIELDS[table_name].values())
+        paginator = client.get_paginator('scan')
+        records = []
+        for page in paginator.paginate(
+                TableName=table_name,
+                ProjectionExpression=', '.join('#a' + str(i) for i in range(len(attributes))),
+                ExpressionAttributeNames={'#a' + str(i): name
+                                          for i, name in enumerate(attributes)}):
+            records.extend(deserialize_item(item) for item in page.get('Items', []))
+        return records
+
+class LocalCatalog(CatalogBackend):
+    """ Reads catalog tables straight from the DB-Data json files, no network needed """
+    name = 'local'
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir or DATA_DIR
+
+    def load_rows(self, table_name):
+        file_name = os.path.join(self.data_dir, table_name + '.json')
+        with open(file_name, encoding='utf-8') as json_file:
+            data = json.load(json_file, parse_float = decimal.Decimal)
+        return build_items(table_name, data)
+
+# COMPILED CATALOGS
+# every table in one file: a header, a table directory, one column of string ids per
+# attribute, then the offsets into a blob holding each distinct string once, little-endian
+CATALOG_FILE = os.path.join(DATA_DIR, 'catalogs.npcc')
+CATALOG_MAGIC = b'NPCC'
+CATALOG_FORMAT_VERSION = 2
+CATALOG_HEADER = struct.Struct('<4sHHII') # magic, version, tables, strings, string offsets
+# name, columns, rows, first column offset, source hash of the json it was compiled from
+CATALOG_TABLE_ENTRY = struct.Struct('<IHIII')
+
+def compile_catalogs(path=None, data_dir=None):
+    """ compiles the DB-Data json files into one binary catalog file """
+    path = path or CATALOG_FILE
+    source = LocalCatalog(data_dir)
+    strings = {}
+
+    def intern(text):
+        return strings.setdefault(str(text), len(strings))
+
+    tables = []
+    for table_name in sorted(TABLE_NAMES):
+        rows = source.load_rows(table_name)
+        # ids are implied by row order, build_items numbers them from 1
+        columns = [(intern(attribute), [intern(row[attribute]) for row in rows])
+                   for attribute in CATALOG_FIELDS[table_name].values()]
+        tables.append((intern(table_name), len(rows), columns,
+                       intern(catalog_source_hash(table_name, data_dir))))
+    offset = CATALOG_HEADER.size + CATALOG_TABLE_ENTRY.size * len(tables)
+    directory = []
+    column_data = []
+    for name_id, row_count, columns, source_id in tables:
+        directory.append(CATALOG_TABLE_ENTRY.pack(name_id, len(columns), row_count, offset,
+                                                  source_id))
+        for attribute_id, values in columns:
+            column_data.append(struct.pack(f'<I{row_count}I', attribute_id, *values))
+            offset += 4 * (row_count + 1)
+    blob = [text.encode('utf-8') for text in strings]
+    string_offsets = [0]
+    for data in blob:
+        string_offsets.append(string_offsets[-1] + len(data))
+    header = CATALOG_HEADER.pack(CATALOG_MAGIC, CATALOG_FORMAT_VERSION, len(tables),
+                                 len(strings), offset)
+    # written beside the target and renamed, so a process mapping the old file is unaffected
+    with open(path + '.tmp', 'wb') as catalog_file:
+        catalog_file.write(b''.join([header] + directory + column_data))
+        catalog_file.write(struct.pack(f'<{len(string_offsets)}I', *string_offsets))
+        catalog_file.write(b''.join(blob))
+    os.replace(path + '.tmp', path)
+    logging.info('Compiled %s tables and %s strings into %s', len(tables), len(strings), path)
+    return path
+
+class BinaryCatalog(CatalogBackend):
+    """ Reads catalog tables from a compiled catalog file mapped into memory """
+    name = 'binary'
+
+    def __init__(self, path=None, data_dir=None):
+        self.path = path or CATALOG_FILE
+        self.data_dir = data_dir
+        self.data = None
+
+    def open(self):
+        """ maps the file read-only, so every process shares the same pages """
+        with open(self.path, 'rb') as catalog_file:
+            data = mmap.mmap(catalog_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, table_count, string_count, strings_at = \
+            CATALOG_HEADER.unpack_from(data, 0)
+        if magic != CATALOG_MAGIC or version != CATALOG_FORMAT_VERSION:
+            raise ValueError(f'{self.path} is not a version {CATALOG_FORMAT_VERSION} '
+                             'catalog file, run npc_builder.py --compile-catalogs')
+        self.string_offsets = struct.unpack_from(f'<{string_count + 1}I', data, strings_at)
+        self.strings_at = strings_at + 4 * (string_count + 1)
+        self.data = data
+        self.tables = {}
+        for position in range(table_count):
+            name_id, column_count, row_count, columns_at, source_id = \
+                CATALOG_TABLE_ENTRY.unpack_from(
+                    data, CATALOG_HEADER.size + CATALOG_TABLE_ENTRY.size * position)
+            self.tables[self.string(name_id)] = (column_count, row_count, columns_at,
+                                                 self.string(source_id))
+
+    def string(self, string_id):
+        """ decodes one interned string straight out of the mapped file """
+        start = self.strings_at + self.string_offsets[string_id]
+        end = self.strings_at + self.string_offsets[string_id + 1]
+        return self.data[start:end].decode('utf-8')
+
+    def load_rows(self, table_name):
+        if self.data is None:
+            self.open()
+        column_count, row_count, columns_at, source_hash = self.tables[table_name]
         try:
-            table = dynamodb.Table(table_name)
-            item_count = count_items_db(table)
-            if item_count == 0:
-                return False
-        except:
-            return False
-    return True
+            current_hash = catalog_source_hash(table_name, self.data_dir)
+        except FileNotFoundError:
+            # the compiled file may be deployed without the json it came from
+            current_hash = source_hash
+        if current_hash != source_hash:
+            raise ValueError(f'The {table_name} catalog in {self.path} is older than its json '
+                             'file, run npc_builder.py --compile-catalogs')
+        strings = {}
+        records = [{table_name + '_id': item_id} for item_id in range(1, row_count + 1)]
+        for column in range(column_count):
+            attribute_id, *values = struct.unpack_from(
+                f'<I{row_count}I', self.data, columns_at + 4 * (row_count + 1) * column)
+            attribute = self.string(attribute_id)
+            for record, string_id in zip(records, values):
+                # each distinct string is decoded once per table
+                if string_id not in strings:
+                    strings[string_id] = self.string(string_id)
+                record[attribute] = strings[string_id]
+        return records
+
+CATALOG_BACKENDS = {
+    DynamoDBCatalog.name: DynamoDBCatalog,
+    LocalCatalog.name: LocalCatalog,
+    BinaryCatalog.name: BinaryCatalog
+}
+
+def get_catalog_backend():
+    """ the backend the catalog cache loads from, chosen by NPC_CATALOG_BACKEND """
+    global _catalog_backend
+    if _catalog_backend is None:
+        _catalog_backend = CATALOG_BACKENDS[CATALOG_BACKEND]()
+    return _catalog_backend
+
+def set_catalog_backend(backend):
+    """ switches the catalog backend by name or instance and empties the cache """
+    global _catalog_backend
+    if isinstance(backend, str):
+        backend = CATALOG_BACKENDS[backend]()
+    _catalog_backend = backend
+    refresh_catalog()
+
+# CATALOG CACHE
+def load_catalog(table_name):
+    """ loads a table once and keeps its rows in memory sorted by id """
+    key_name = table_name + '_id'
+    with timed('load_catalog', table_name):
+        records = get_catalog_backend().load_rows(table_name)
+    records.sort(key=lambda item: int(item[key_name]))
+    catalog = {
+        'loaded_at': time.time(),
+        'rows': records,
+        'values': [item[table_name] for item in records],
+        'ids': {int(item[key_name]): item for item in records},
+        'index': {item[table_name]: item for item in records}
+    }
+    _catalog[table_name] = catalog
+    logging.info('Loaded %s records from %s into the catalog cache (%s backend)',
+                 len(records), table_name, get_catalog_backend().name)
+    return catalog
+
+def get_catalog(table_name):
+    """ returns the cached rows for a table, reloading them once the TTL expires """
+    catalog = _catalog.get(table_name)
+    if catalog is None or time.time() - catalog['loaded_at'] > CATALOG_TTL:
+        catalog = load_catalog(table_name)
+    return catalog
+
+def refresh_catalog(table_name=None):
+    """ drops one table (or every table) from the cache so it is reloaded on next use """
+    if table_name is None:
+        _catalog.clear()
+    else:
+        _catalog.pop(table_name, None)
+
+def preload_catalogs():
+    """ loads every table into the cache up front """
+    for table_name in TABLE_NAMES:
+        get_catalog(table_name)
+
+def catalog_count(table_name):
+    """ number of cached rows in a table """
+    return len(get_catalog(table_name)['rows'])
+
+def catalog_lookup(table_name, key_num):
+    """ returns the cached row with the given id """
+    return get_catalog(table_name)['ids'][key_num]
+
+def catalog_find(table_name, value):
+    """ returns the cached row whose main attribute matches value """
+    return get_catalog(table_name)['index'][value]
+
+def get_name_index():
+    """ first names bucketed by gender, non-binary names are in every bucket """
+    catalog = get_catalog('first_name')
+    if 'by_gender' not in catalog:
+        shared = [item['first_name'] for item in catalog['rows']
+                  if item['name_gender'] == 'Non-binary']
+        buckets = {'Non-binary': shared}
+        for item in catalog['rows']:
+            if item['name_gender'] != 'Non-binary':
+                buckets.setdefault(item['name_gender'], list(shared)).append(item['first_name'])
+        catalog['by_gender'] = buckets
+    return catalog['by_gender']
 
-def get_random_key(table_name):
-    """ uses total items in table to generate a random number """
-    table = dynamodb.Table(table_name)
-    item_count = count_items_db(table)
-    return random.randrange(1,item_count)
+def get_gender_names(gender):
+    """ first names that suit a gender, falling back to the non-binary names """
+    name_index = get_name_index()
+    return name_index.get(gender) or name_index['Non-binary']
 
-def get_random_gender():
+# WEIGHTED SAMPLING
+# relative weights for catalog values, anything not listed has a weight of 1, e.g.
+# ATTRIBUTE_WEIGHTS = {'race': {'Human': 3, 'Half-Orc': 0.5}}
+ATTRIBUTE_WEIGHTS = {}
+# stats each race is suited to, classes whose primary stat names one are more likely
+RACE_STAT_AFFINITY = {
+    'Dragonborn': ['Strength', 'Charisma'],
+    'Dwarf': ['Constitution'],
+    'Elf': ['Dexterity'],
+    'Gnome': ['Intelligence'],
+    'Half-Elf': ['Charisma'],
+    'Halfling': ['Dexterity'],
+    'Half-Orc': ['Strength', 'Constitution'],
+    'Human': [], # humans take to every class equally
+    'Tiefling': ['Charisma', 'Intelligence']
+}
+RACE_CLASS_AFFINITY = 3 # weight of a class suited to the race, the others have 1
+# traits that contradict each other are never given to the same character
+TRAIT_EXCLUSIONS = [
+    ('Abrasive', 'Accommodating'), ('Abrasive', 'Affable'), ('Abrasive', 'Agreeable'),
+    ('Adorable', 'Repulsive'), ('Aggressive', 'Gentle'), ('Aggressive', 'Peaceful'),
+    ('Agnostic', 'Religious'), ('Always late', 'Punctual'), ('Brave', 'Cowardly'),
+    ('Brave', 'Fearful'), ('Calm', 'Anxious'), ('Careful', 'Careless'),
+    ('Cheerful', 'Gloomy'), ('Clean', 'Dirty'), ('Compassionate', 'Heartless'),
+    ('Confident', 'Insecure'), ('Courageous', 'Cowardly'), ('Curious', 'Apathetic'),
+    ('Decisive', 'Indecisive'), ('Energetic', 'Lethargic'), ('Forgiving', 'Vengeful'),
+    ('Friendly', 'Hostile'), ('Friendly', 'Unfriendly'), ('Generous', 'Greedy'),
+    ('Generous', 'Stingy'), ('Happy', 'Sad'), ('Honest', 'Deceitful'),
+    ('Honest', 'Dishonest'), ('Honest', 'Liar'), ('Humble', 'Arrogant'),
+    ('Humble', 'Conceited'), ('Intelligent', 'Stupid'), ('Kind', 'Cruel'),
+    ('Kind', 'Mean'), ('Lazy', 'Industrious'), ('Loyal', 'Disloyal'),
+    ('Loyal', 'Treacherous'), ('Mature', 'Immature'), ('Modest', 'Vain'),
+    ('Naive', 'Cynical'), ('Optimistic', 'Pessimistic'), ('Organized', 'Disorganized'),
+    ('Patient', 'Impatient'), ('Polite', 'Rude'), ('Quiet', 'Loud'),
+    ('Reckless', 'Cautious'), ('Responsible', 'Irresponsible'), ('Selfish', 'Selfless'),
+    ('Sensitive', 'Insensitive'), ('Serious', 'Silly'), ('Shy', 'Outgoing'),
+    ('Tolerant', 'Intolerant'), ('Trusting', 'Paranoid'), ('Trusting', 'Suspicious'),
+    ('Wise', 'Foolish')
+]
+TRAITS_PER_CHARACTER = 3
+MAX_TRAIT_DRAWS = 100 # redraws allowed before giving up on a set of compatible traits
+
+class AliasTable:
+    """ Vose's alias method: any weighted draw costs one random number and one lookup """
+
+    def __init__(self, values, weights):
+        count = len(values)
+        total = sum(weights)
+        if count == 0 or total <= 0:
+            raise ValueError('An alias table needs at least one value with a positive weight')
+        scaled = [weight * count / total for weight in weights]
+        self.values = list(values)
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+    def draw_index(self, rng):
+        """ position of one weighted draw """
+        position = rng.random() * len(self.values)
+        column = min(int(position), len(self.values) - 1)
+        if position - column < self.probability[column]:
+            return column
+        return self.alias[column]
+
+    def draw(self, rng):
+        """ one weighted draw """
+        return self.values[self.draw_index(rng)]
+
+    def sample(self, rng, k):
+        """ k independent weighted draws """
+        draw = self.draw
+        return [draw(rng) for _ in range(k)]
+
+def get_sampler(table_name):
+    """ alias table over a table's values weighted by ATTRIBUTE_WEIGHTS """
+    catalog = get_catalog(table_name)
+    if 'sampler' not in catalog:
+        weights = ATTRIBUTE_WEIGHTS.get(table_name, {})
+        catalog['sampler'] = AliasTable(catalog['values'],
+                                        [weights.get(value, 1) for value in catalog['values']])
+    return catalog['sampler']
+
+def class_weight(race, item):
+    """ weight of a class for a race, from its primary stat and the race's affinities """
+    weight = ATTRIBUTE_WEIGHTS.get('class_type', {}).get(item['class_type'], 1)
+    if any(stat in item.get('primary_stat', '') for stat in RACE_STAT_AFFINITY.get(race, [])):
+        weight *= RACE_CLASS_AFFINITY
+    return weight
+
+def get_class_sampler(race):
+    """ alias table over the classes weighted towards those that suit a race """
+    catalog = get_catalog('class_type')
+    samplers = catalog.setdefault('sampler_by_race', {})
+    if race not in samplers:
+        samplers[race] = AliasTable(catalog['values'],
+                                    [class_weight(race, item) for item in catalog['rows']])
+    return samplers[race]
+
+def get_trait_exclusions():
+    """ the traits each trait may not be paired with """
+    catalog = get_catalog('trait')
+    if 'exclusions' not in catalog:
+        exclusions = {}
+        for first, second in TRAIT_EXCLUSIONS:
+            exclusions.setdefault(first, set()).add(second)
+            exclusions.setdefault(second, set()).add(first)
+        catalog['exclusions'] = exclusions
+    return catalog['exclusions']
+
+def sample_traits(rng, k=TRAITS_PER_CHARACTER):
+    """ k different traits with no contradicting pair, redrawing any that clash """
+    sampler = get_sampler('trait')
+    exclusions = get_trait_exclusions()
+    traits = []
+    blocked = set()
+    for _ in range(MAX_TRAIT_DRAWS):
+        trait = sampler.draw(rng)
+        if trait not in blocked:
+            traits.append(trait)
+            if len(traits) == k:
+                return traits
+            blocked.add(trait)
+            blocked.update(exclusions.get(trait, ()))
+    raise ValueError(f'Could not draw {k} compatible traits')
+
+def get_random_key(table_name, rng=None):
+    """ draws the id of a weighted random item in a table """
+    # catalog rows are numbered from 1 in the order the sampler holds them
+    return get_sampler(table_name).draw_index(rng or _rng) + 1
+
+def get_random_gender(rng=None):
     print('*  Randomly selecting a gender...                             *')
-    key_num = get_random_key('gender')
+    key_num = get_random_key('gender', rng)
     try:
-        table = dynamodb.Table('gender')
-        response = table.query(
-            ProjectionExpression="gender",
-            KeyConditionExpression=Key('gender_id').eq(key_num)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        gender = json_loads_response['gender']
+        item = catalog_lookup('gender', key_num)
+        gender = item['gender']
         logging.info('Gender selected: %s', gender)
     except ClientError as err:
         print(err)
@@ -339,28 +1195,12 @@ def get_random_gender():
     return gender
 
 def display_table_contents(table_name):
-    try:
-        table = dynamodb.Table(table_name)
-        item_count = count_items_db(table)
-        item_num = 0
-        key_name = table_name + '_id'
-        for item in range(item_count):
-            item_num += 1
-            response = table.query(
-                ProjectionExpression=table_name,
-                KeyConditionExpression=Key(key_name).eq(item_num)
-            )
-            # parse json to get just the attribute value we want
-            json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-            json_loads_response = json.loads(json_dumps_response)
-            item = json_loads_response[table_name]
-            print(f'    {item_num}. {item}')
-    except ClientError as err:
-        print(err)
-        logging.error(
-            "Couldn't get items from table. Here's why: %s: %s",
-            err.response['Error']['Code'], err.response['Error']['Message'])
-    return item
+    """ prints a table's values numbered by id and returns them in that order """
+    # served from the catalog cache, a cold table costs one paginated scan
+    options = get_catalog(table_name)['values']
+    for item_num, item in enumerate(options, start=1):
+        print(f'    {item_num}. {item}')
+    return options
 
 def select_gender():
     """ Allows user to either use a random gender or select a gender """ 
@@ -370,18 +1210,10 @@ def select_gender():
         return gender
     try:
         print('Available Genders: ')
-        table = dynamodb.Table('gender')
-        display_table_contents('gender')
-        max_num = count_items_db(table)
-        user_choice = user_number_choice(max_num)
-        response = table.query(
-            ProjectionExpression="gender",
-            KeyConditionExpression=Key('gender_id').eq(user_choice)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        gender = json_loads_response['gender']
+        # the printed options, the range check and the choice share one lookup
+        options = display_table_contents('gender')
+        user_choice = user_number_choice(len(options))
+        gender = options[user_choice - 1]
         logging.info('Gender selected: %s', gender)
         return gender
     except ClientError as err:
@@ -391,45 +1223,24 @@ def select_gender():
             err.response['Error']['Code'], err.response['Error']['Message'])
     return gender
 
-def get_random_name(gender):
+def get_random_name(gender, rng=None):
     """ Get a random name that matches the gender from DynamoDB table """
     print('*  Randomly selecting a gender appropriate name...            *')
     # First Name
     try:
-        table = dynamodb.Table('first_name')
-        name_found = False
-        while name_found is False:
-            key_num = get_random_key('first_name')
-            response = table.query(
-                ProjectionExpression='first_name, name_gender',
-                KeyConditionExpression=Key('first_name_id').eq(key_num)
-            )
-            # parse json to get just the attribute value we want
-            json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-            json_loads_response = json.loads(json_dumps_response)
-            name_gender = json_loads_response['name_gender']
-            # check that name is gendered correctly
-            if name_gender in [gender, 'Non-binary']:
-                name_found = True
-                first_name = json_loads_response['first_name']
-                logging.info('First name selected: %s', first_name)
+        names = get_gender_names(gender)
+        first_name = names[(rng or _rng).randrange(len(names))]
+        logging.info('First name selected: %s', first_name)
     except ClientError as err:
         print(err)
         logging.error(
             "Couldn't get first name from table. Here's why: %s: %s",
             err.response['Error']['Code'], err.response['Error']['Message'])
     # Family Name
-    key_num = get_random_key('family_name')
+    key_num = get_random_key('family_name', rng)
     try:
-        table = dynamodb.Table('family_name')
-        response = table.query(
-            ProjectionExpression='family_name',
-            KeyConditionExpression=Key('family_name_id').eq(key_num)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        family_name = json_loads_response['family_name']
+        item = catalog_lookup('family_name', key_num)
+        family_name = item['family_name']
         logging.info('Family name selected: %s', family_name)
         full_name = first_name + " " + family_name
     except ClientError as err:
@@ -459,20 +1270,13 @@ def select_name(gender):
     logging.info('Name enterered: %s', name)
     return name
 
-def get_random_profession():
+def get_random_profession(rng=None):
     """ Get a random profession from DynamoDB table """
     print('*  Randomly selecting a profession...                         *')
-    key_num = get_random_key('profession')
+    key_num = get_random_key('profession', rng)
     try:
-        table = dynamodb.Table('profession')
-        response = table.query(
-            ProjectionExpression='profession',
-            KeyConditionExpression=Key('profession_id').eq(key_num)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        profession = json_loads_response['profession']
+        item = catalog_lookup('profession', key_num)
+        profession = item['profession']
         logging.info('Profession selected: %s', profession)
     except ClientError as err:
         print(err)
@@ -489,18 +1293,10 @@ def select_profession():
         return profession
     try:
         print('Available Professions: ')
-        table = dynamodb.Table('profession')
-        display_table_contents('profession')
-        max_num = count_items_db(table)
-        user_choice = user_number_choice(max_num)
-        response = table.query(
-            ProjectionExpression="profession",
-            KeyConditionExpression=Key('profession_id').eq(user_choice)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        profession = json_loads_response['profession']
+        # the printed options, the range check and the choice share one lookup
+        options = display_table_contents('profession')
+        user_choice = user_number_choice(len(options))
+        profession = options[user_choice - 1]
         logging.info('Profession selected: %s', profession)
     except ClientError as err:
         print(err)
@@ -512,16 +1308,8 @@ def select_profession():
 def get_profession_desc(profession):
     """ Get a profession description from DynamoDB table """
     try:
-        table = dynamodb.Table('profession')
-        response = table.query(
-            IndexName = 'profession_index',
-            ProjectionExpression="profession_description",
-            KeyConditionExpression=Key('profession').eq(profession)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        profession_desc = json_loads_response['profession_description']
+        item = catalog_find('profession', profession)
+        profession_desc = item['profession_description']
     except ClientError as err:
         print(err)
         logging.error(
@@ -529,20 +1317,16 @@ def get_profession_desc(profession):
             err.response['Error']['Code'], err.response['Error']['Message'])
     return profession_desc
 
-def get_random_class():
-    """ Get a random class from DynamoDB table """
+def get_random_class(rng=None, race=None):
+    """ Get a random class from DynamoDB table, favouring classes that suit race """
     print('*  Randomly selecting a class...                              *')
-    key_num = get_random_key('class_type')
+    if race is None:
+        key_num = get_random_key('class_type', rng)
+    else:
+        key_num = get_class_sampler(race).draw_index(rng or _rng) + 1
     try:
-        table = dynamodb.Table('class_type')
-        response = table.query(
-            ProjectionExpression='class_type',
-            KeyConditionExpression=Key('class_type_id').eq(key_num)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        class_type = json_loads_response['class_type']
+        item = catalog_lookup('class_type', key_num)
+        class_type = item['class_type']
         logging.info('Class selected: %s', class_type)
     except ClientError as err:
         print(err)
@@ -558,19 +1342,11 @@ def select_class():
         class_type = get_random_class()
         return class_type
     try:
-        table = dynamodb.Table('class_type')
         print('Available classes: ')
-        display_table_contents('class_type')
-        max_num = count_items_db(table)
-        user_choice = user_number_choice(max_num)
-        response = table.query(
-            ProjectionExpression="class_type",
-            KeyConditionExpression=Key('class_type_id').eq(user_choice)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        class_type = json_loads_response['class_type']
+        # the printed options, the range check and the choice share one lookup
+        options = display_table_contents('class_type')
+        user_choice = user_number_choice(len(options))
+        class_type = options[user_choice - 1]
         logging.info('Class selected: %s', class_type)
     except ClientError as err:
         print(err)
@@ -582,16 +1358,8 @@ def select_class():
 def get_class_desc(class_type):
     """ Get a class description from DynamoDB table """
     try:
-        table = dynamodb.Table('class_type')
-        response = table.query(
-            IndexName='class_type_index',
-            ProjectionExpression="class_description",
-            KeyConditionExpression=Key('class_type').eq(class_type)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        class_desc = json_loads_response['class_description']
+        item = catalog_find('class_type', class_type)
+        class_desc = item['class_description']
     except ClientError as err:
         print(err)
         logging.error(
@@ -599,20 +1367,13 @@ def get_class_desc(class_type):
             err.response['Error']['Code'], err.response['Error']['Message'])
     return class_desc
 
-def get_random_race():
+def get_random_race(rng=None):
     """ Get a random race from DynamoDB table """
     print('*  Randomly selecting a race...                               *')
-    key_num = get_random_key('race')
+    key_num = get_random_key('race', rng)
     try:
-        table = dynamodb.Table('race')
-        response = table.query(
-            ProjectionExpression='race',
-            KeyConditionExpression=Key('race_id').eq(key_num)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        race = json_loads_response['race']
+        item = catalog_lookup('race', key_num)
+        race = item['race']
         logging.info('Race selected: %s', race)
     except ClientError as err:
         print(err)
@@ -628,19 +1389,11 @@ def select_race():
         race = get_random_race()
         return race
     try:
-        table = dynamodb.Table('race')
         print('Available classes: ')
-        display_table_contents('race')
-        max_num = count_items_db(table)
-        user_choice = user_number_choice(max_num)
-        response = table.query(
-            ProjectionExpression="race",
-            KeyConditionExpression=Key('race_id').eq(user_choice)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        race = json_loads_response['race']
+        # the printed options, the range check and the choice share one lookup
+        options = display_table_contents('race')
+        user_choice = user_number_choice(len(options))
+        race = options[user_choice - 1]
         logging.info('Class selected: %s', race)
     except ClientError as err:
         print(err)
@@ -652,16 +1405,8 @@ def select_race():
 def get_race_desc(race):
     """ Get a race description from DynamoDB table """
     try:
-        table = dynamodb.Table('race')
-        response = table.query(
-            IndexName='race_index',
-            ProjectionExpression="race_description",
-            KeyConditionExpression=Key('race').eq(race)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        race_desc = json_loads_response['race_description']
+        item = catalog_find('race', race)
+        race_desc = item['race_description']
     except ClientError as err:
         print(err)
         logging.error(
@@ -669,29 +1414,26 @@ def get_race_desc(race):
             err.response['Error']['Code'], err.response['Error']['Message'])
     return race_desc
 
-def get_random_traits():
+def get_random_traits(rng=None):
     """ Get three random traits from DynamoDB table """
     print('*  Randomly selecting three traits...                         *')
     traits = []
-    for num in range(3):
-        key_num = get_random_key('trait')
-        try:
-            table = dynamodb.Table('trait')
-            response = table.query(
-                ProjectionExpression="trait",
-                KeyConditionExpression=Key('trait_id').eq(key_num)
-            )
-            # parse json to get just the attribute value we want
-            json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-            json_loads_response = json.loads(json_dumps_response)
-            trait = json_loads_response['trait']
-            logging.info('Trait selected: %s', trait)
-            traits.append(trait)
-        except ClientError as err:
-            print(err)
-            logging.error(
-                "Couldn't get traits from table. Here's why: %s: %s",
-                err.response['Error']['Code'], err.response['Error']['Message'])
+    try:
+        traits = sample_traits(rng or _rng)
+        logging.info('Traits selected: %s', ', '.join(traits))
+    except ClientError as err:
+        print(err)
+        logging.error(
+            "Couldn't get traits from table. Here's why: %s: %s",
+            err.response['Error']['Code'], err.response['Error']['Message'])
+    except ValueError as err:
+        print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        print('!  Could not find three traits that do not contradict.        !')
+        print('!  Check the trait catalog and its exclusions.                !')
+        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+        logging.error("Couldn't draw traits. Here's why: %s", err)
+        # a character needs all three traits, so the caller has to stop here
+        raise
     return traits
 
 def select_traits():
@@ -717,20 +1459,13 @@ def select_traits():
         print(err)
     return traits
 
-def get_random_quirk():
+def get_random_quirk(rng=None):
     """ Get a random quirk from DynamoDB table """
     print('*  Randomly selecting a quirk...                              *')
-    key_num = get_random_key('quirk')
+    key_num = get_random_key('quirk', rng)
     try:
-        table = dynamodb.Table('quirk')
-        response = table.query(
-            ProjectionExpression="quirk",
-            KeyConditionExpression=Key('quirk_id').eq(key_num)
-        )
-        # parse json to get just the attribute value we want
-        json_dumps_response = json.dumps(response['Items'][0], skipkeys=True)
-        json_loads_response = json.loads(json_dumps_response)
-        quirk = json_loads_response['quirk']
+        item = catalog_lookup('quirk', key_num)
+        quirk = item['quirk']
         logging.info('Quirk selected: %s', quirk)
     except ClientError as err:
         print(err)
@@ -772,67 +1507,371 @@ def display_character(gender, name, profession, class_type, race, traits, quirk)
     quirk_string = wrapper.fill(text=quirk)
     print(textwrap.indent(text=quirk_string, prefix='        '))
 
-def save_character(gender, name, profession, class_type, race, traits, quirk):
+# ASYNC RANDOM CHARACTER
+# the picks themselves are served from the catalog cache, so the only waiting is on
+# loading catalogs; each table loads in a worker thread and all of them load at once
+async def load_catalog_async(table_name):
+    """ loads one table into the cache without blocking the event loop """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_catalog, table_name)
+
+async def load_catalogs_async(table_names=TABLE_NAMES):
+    """ loads several tables concurrently, so a cold cache costs about one round trip """
+    return await asyncio.gather(*(load_catalog_async(table_name)
+                                  for table_name in sorted(table_names)))
+
+async def get_random_character_async(rng=None):
+    """ Loads every table a character needs at once, then draws its attributes in order """
+    await load_catalogs_async()
+    # drawn one after another so a seeded generator always gives the same character
+    gender = get_random_gender(rng)
+    name = get_random_name(gender, rng)
+    profession = get_random_profession(rng)
+    # the race is drawn first so the class can suit it
+    race = get_random_race(rng)
+    return {
+        'gender': gender,
+        'name': name,
+        'profession': profession,
+        'class_type': get_random_class(rng, race),
+        'race': race,
+        'traits': get_random_traits(rng),
+        'quirk': get_random_quirk(rng)
+    }
+
+def get_random_character(rng=None):
+    """ Runs get_random_character_async from code that is not already async """
+    return asyncio.run(get_random_character_async(rng))
+
+# BULK CHARACTER GENERATION
+CHARACTER_FIELDS = ['gender', 'name', 'profession', 'class_type', 'race', 'traits', 'quirk']
+GENERATION_BATCH_SIZE = 1000
+
+def generate_characters(n, seed=None, workers=1):
+    """ Yields n random characters drawn in batches from the cached catalogs """
+    # each batch gets its own generator spawned from seed, so a seeded run gives
+    # the same characters in the same order whatever the number of workers
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+    preload_catalogs()
+    batches = ((spawn_seed(seed, index), min(GENERATION_BATCH_SIZE, n - start))
+               for index, start in enumerate(range(0, n, GENERATION_BATCH_SIZE)))
+    if workers and workers > 1:
+        # forked workers inherit the preloaded catalogs, spawned ones load their own
+        # from the same backend; only a few batches are in flight so output streams
+        pending = collections.deque()
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_generation_worker,
+                                 initargs=(get_catalog_backend().name,)) as executor:
+            for batch_seed, size in batches:
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+                pending.append(executor.submit(generate_character_batch, batch_seed, size))
+            while pending:
+                yield from pending.popleft().result()
+    else:
+        for batch_seed, size in batches:
+            yield from generate_character_batch(batch_seed, size)
+
+def init_generation_worker(backend_name):
+    """ Runs in each generation process: reads the catalogs from the parent's backend """
+    if get_catalog_backend().name != backend_name:
+        set_catalog_backend(backend_name)
+
+@timed('generate_batch')
+def generate_character_batch(batch_seed, size):
+    """ Draws every attribute for a batch of characters from one seeded generator """
+    rng = make_rng(batch_seed)
+    genders = get_catalog('gender')['values']
+    names_by_gender = {gender: get_gender_names(gender) for gender in genders}
+    class_samplers = {race: get_class_sampler(race) for race in get_catalog('race')['values']}
+    batch_genders = get_sampler('gender').sample(rng, size)
+    batch_family_names = get_sampler('family_name').sample(rng, size)
+    batch_professions = get_sampler('profession').sample(rng, size)
+    batch_races = get_sampler('race').sample(rng, size)
+    batch_quirks = get_sampler('quirk').sample(rng, size)
+    characters = []
+    for i in range(size):
+        gender = batch_genders[i]
+        race = batch_races[i]
+        characters.append({
+            'gender': gender,
+            'name': rng.choice(names_by_gender[gender]) + ' ' + batch_family_names[i],
+            'profession': batch_professions[i],
+            'class_type': class_samplers[race].draw(rng),
+            'race': race,
+            'traits': sample_traits(rng),
+            'quirk': batch_quirks[i]
+        })
+    return characters
+
+def write_characters(characters, output, output_format='jsonl'):
+    """ Streams characters to an open file as JSON lines or CSV rows """
+    count = 0
+    if output_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(['gender', 'name', 'profession', 'class_type', 'race',
+                         'trait_1', 'trait_2', 'trait_3', 'quirk'])
+        for character in characters:
+            writer.writerow([character['gender'], character['name'], character['profession'],
+                             character['class_type'], character['race']]
+                            + character['traits'] + [character['quirk']])
+            count += 1
+    else:
+        for character in characters:
+            output.write(json.dumps(character) + '\n')
+            count += 1
+    return count
+
+# CHARACTER SHEET TEMPLATE
+SHEET_FONT = 'Times'
+SHEET_FONT_SIZE = 12
+# every line of a character sheet: text with the character's fields, font style, line height
+CHARACTER_SHEET = [
+    ('Name: {name}', 'B', 10),
+    ('Gender: {gender}', '', 10),
+    ('Race: {race} - {race_desc}', '', 10),
+    ('Profession: {profession} - {profession_desc}', '', 10),
+    ('Class: {class_type} - {class_desc}', '', 10),
+    ('Traits: ', '', 10),
+    ('1. {trait_1}', '', 5),
+    ('2. {trait_2}', '', 5),
+    ('3. {trait_3}', '', 5),
+    ('Quirk: {quirk}', '', 10)
+]
+_measure_pdfs = {}
+
+@functools.lru_cache(maxsize=65536)
+def sheet_word_width(word, style):
+    """ width of a word in the sheet font, measured once per word and style """
+    if style not in _measure_pdfs:
+        pdf = load_fpdf()('P', 'mm', 'letter')
+        pdf.set_font(SHEET_FONT, style, SHEET_FONT_SIZE)
+        _measure_pdfs[style] = pdf
+    return _measure_pdfs[style].get_string_width(word)
+
+def sheet_line_width():
+    """ usable width of a line on a letter page, the same for every sheet """
+    pdf = _measure_pdfs.get('') or load_fpdf()('P', 'mm', 'letter')
+    return pdf.w - pdf.l_margin - pdf.r_margin - 2 * pdf.c_margin
+
+@functools.lru_cache(maxsize=4096)
+def wrap_sheet_line(text, style):
+    """ splits text into lines that fit the page, the same way multi_cell wraps on spaces """
+    max_width = sheet_line_width()
+    space_width = sheet_word_width(' ', style)
+    lines = []
+    words = []
+    width = 0
+    for word in text.split(' '):
+        word_width = sheet_word_width(word, style)
+        if words and width + space_width + word_width > max_width:
+            lines.append(' '.join(words))
+            words = [word]
+            width = word_width
+        else:
+            width += (space_width if words else 0) + word_width
+            words.append(word)
+    lines.append(' '.join(words))
+    return tuple(lines)
+
+# the core PDF fonts only cover latin-1, so common typographic characters are swapped
+LATIN1_REPLACEMENTS = str.maketrans({'\u2014': '-', '\u2013': '-', '\u2018': "'",
+                                     '\u2019': "'", '\u201c': '"', '\u201d': '"',
+                                     '\u2026': '...'})
+
+def latin1_text(text):
+    """ makes text printable in the core PDF fonts """
+    return text.translate(LATIN1_REPLACEMENTS).encode('latin-1', 'replace').decode('latin-1')
+
+def write_character_sheet(pdf, fields):
+    """ Fills one character's fields into the template on the current page """
+    style = None
+    for text, line_style, height in CHARACTER_SHEET:
+        if line_style != style:
+            pdf.set_font(SHEET_FONT, line_style, SHEET_FONT_SIZE)
+            style = line_style
+        for line in wrap_sheet_line(latin1_text(text.format(**fields)), line_style):
+            pdf.cell(0, height, line, ln=1)
+
+def sheet_fields(gender, name, profession, class_type, race, traits, quirk,
+                 race_desc, profession_desc, class_desc):
+    """ The values the template's placeholders are filled with """
+    return {
+        'gender': gender, 'name': name, 'profession': profession, 'class_type': class_type,
+        'race': race, 'trait_1': traits[0], 'trait_2': traits[1], 'trait_3': traits[2],
+        'quirk': quirk, 'race_desc': race_desc, 'profession_desc': profession_desc,
+        'class_desc': class_desc
+    }
+
+def build_character_pdf(gender, name, profession, class_type, race, traits, quirk,
+                        race_desc, profession_desc, class_desc):
+    """ Lays out a character sheet and returns the FPDF document """
+    load_fpdf()
+    with timed('render_sheet'):
+        pdf = PDF('P', 'mm', 'letter')
+        pdf.add_page()
+        write_character_sheet(pdf, sheet_fields(gender, name, profession, class_type, race,
+                                                traits, quirk, race_desc, profession_desc,
+                                                class_desc))
+    return pdf
+
+# ROSTER EXPORT
+ROSTER_INDEX_LINES = 40 # index entries printed on each index page
+
+def build_roster_pdf(characters, title='NPC Roster', index=True):
+    """ Lays out many characters in one document, one page each, after an optional index """
+    load_fpdf()
+    pdf = PDF('P', 'mm', 'letter')
+    if index:
+        links = [pdf.add_link() for _ in characters]
+        for start in range(0, len(characters), ROSTER_INDEX_LINES):
+            pdf.add_page()
+            pdf.set_font(SHEET_FONT, 'B', SHEET_FONT_SIZE)
+            pdf.cell(0, 10, latin1_text(title), ln=1)
+            pdf.set_font(SHEET_FONT, '', SHEET_FONT_SIZE)
+            for number in range(start, min(start + ROSTER_INDEX_LINES, len(characters))):
+                character = characters[number]
+                entry = (str(number + 1) + '. ' + character['name'] + ' - ' + character['race']
+                         + ' ' + character['class_type'])
+                pdf.cell(0, 5, latin1_text(entry), ln=1, link=links[number])
+    all_descriptions = resolve_descriptions(characters)
+    for number, character in enumerate(characters):
+        pdf.add_page()
+        if index:
+            pdf.set_link(links[number])
+        write_character_sheet(pdf, sheet_fields(**character, **all_descriptions[number]))
+    return pdf
+
+def save_roster(characters, title='NPC Roster', index=True, keep_local=False):
+    """ Renders characters into one roster PDF and uploads it as a single object """
+    characters = list(characters)
+    start = time.perf_counter()
+    data = pdf_bytes(build_roster_pdf(characters, title, index))
+    seconds = time.perf_counter() - start
+    timestamp = datetime.now().strftime("%d-%m-%y_%H%M")
+    pdf_name = 'NPC-Builder_Roster_' + title + '-' + timestamp + '.pdf'
+    logging.info('Rendered a roster of %s characters in %.2fs (%.0f/sec)',
+                 len(characters), seconds, len(characters) / max(seconds, 0.001))
+    if keep_local:
+        with open(pdf_name, 'wb') as pdf_file:
+            pdf_file.write(data)
+    upload_to_s3(pdf_name, data)
+    return pdf_name
+
+# sheet field: (character field and table, description attribute)
+DESCRIPTION_FIELDS = {
+    'race_desc': ('race', 'race_description'),
+    'profession_desc': ('profession', 'profession_description'),
+    'class_desc': ('class_type', 'class_description')
+}
+
+def resolve_descriptions(characters, cache=None):
+    """ Looks up the descriptions for a batch of characters, each distinct value once """
+    # cache maps (table, value) to a description and can be shared between batches
+    if cache is None:
+        cache = {}
+    resolved = []
+    try:
+        for character in characters:
+            descriptions = {}
+            for field, (table_name, attribute) in DESCRIPTION_FIELDS.items():
+                key = (table_name, character[table_name])
+                if key not in cache:
+                    # the cached catalog holds the whole table, so this costs no round trip
+                    cache[key] = catalog_find(table_name, key[1])[attribute]
+                descriptions[field] = cache[key]
+            resolved.append(descriptions)
+    except ClientError as err:
+        print(err)
+        logging.error(
+            "Couldn't get descriptions from table. Here's why: %s: %s",
+            err.response['Error']['Code'], err.response['Error']['Message'])
+        raise
+    return resolved
+
+def character_descriptions(race, profession, class_type):
+    """ Looks up the descriptions printed next to a character's race, profession and class """
+    return resolve_descriptions([{'race': race, 'profession': profession,
+                                  'class_type': class_type}])[0]
+
+def character_pdf_name(name, timestamp, number=None):
+    """ File name a character sheet is saved under locally and in S3 """
+    if number is None:
+        return 'NPC-Builder_' + name + '-' + timestamp + '.pdf'
+    return 'NPC-Builder_' + name + '-' + timestamp + '-' + str(number) + '.pdf'
+
+def save_character(gender, name, profession, class_type, race, traits, quirk,
+                   keep_local=None):
     """ Create a PDF of character information and save it to S3 """
     print("\n************************* PROCESSING *************************")
-    print("*  Initiating PDF...                                         *")
-    pdf = FPDF('P', 'mm', 'letter')
-    pdf.add_page()
-    pdf.set_font('Times', 'B', 12)
-    print("*  Adding character name...                                  *")
-    pdf.cell(0, 10, 'Name: ' + name, ln=1)
-    pdf.set_font('Times', '', 12)
-    print("*  Adding character gender...                                *")
-    pdf.cell(0, 10, 'Gender: ' + gender, ln=1)
-    print("*  Adding character race...                                  *")
-    race_desc = get_race_desc(race)
-    pdf.multi_cell(0, 10, 'Race: ' + race + ' - ' + race_desc)
-    print("*  Adding character profession...                            *")
-    profession_desc = get_profession_desc(profession)
-    pdf.multi_cell(0, 10, 'Profession: ' + profession + ' - ' + profession_desc)
-    print("*  Adding character class...                                 *")
-    class_desc = get_class_desc(class_type)
-    pdf.multi_cell(0, 10, 'Class: ' + class_type + ' - ' + class_desc)
-    print("*  Adding character traits...                                *")
-    pdf.cell(0, 10, 'Traits: ', ln=1)
-    pdf.multi_cell(0, 5, '1. ' + traits[0] \
-            + '\n2. ' + traits[1]\
-            + '\n3. ' + traits[2])
-    print("*  Adding character quirk...                                 *")
-    pdf.multi_cell(0, 10, 'Quirk: ' + quirk)
+    print("*  Looking up character descriptions...                      *")
+    descriptions = character_descriptions(race, profession, class_type)
+    print("*  Building PDF...                                           *")
+    pdf = build_character_pdf(gender, name, profession, class_type, race, traits, quirk,
+                              **descriptions)
     print("*  Finalizing PDF...                                         *")
     now = datetime.now()
     timestamp = now.strftime("%d-%m-%y_%H%M")
-    pdf_name = 'NPC-Builder_' + name + '-' + timestamp + '.pdf'
-    pdf.output(pdf_name, 'F')
-    upload_to_s3(pdf_name)
+    pdf_name = character_pdf_name(name, timestamp)
+    data = pdf_bytes(pdf)
+    if keep_local is None:
+        keep_local = SAVE_LOCAL_COPY
+    if keep_local:
+        with open(pdf_name, 'wb') as pdf_file:
+            pdf_file.write(data)
+    if upload_to_s3(pdf_name, data):
+        character = dict(zip(CHARACTER_FIELDS, (gender, name, profession, class_type, race,
+                                                traits, quirk)))
+        save_character_records([character_record(character, pdf_name)])
+
+def pdf_bytes(pdf):
+    """ Renders an FPDF document into memory instead of a file """
+    data = pdf.output(dest='S')
+    if isinstance(data, str):
+        # pyfpdf returns the document as a latin-1 string
+        data = data.encode('latin-1')
+    return bytes(data)
 
-def upload_to_s3(filename):
-    """Add a file to an Amazon S3 bucket"""
+def upload_to_s3(filename, data):
+    """Add a file already rendered into memory to an Amazon S3 bucket"""
     try:
-        s3.upload_file(filename, BUCKET_NAME, filename)
+        upload_bytes(data, filename)
         logging.info(f'Uploaded {filename} to {BUCKET_NAME}.')
         print("\n*************************** SUCCESS ***************************")
         print(f'{filename} was saved successfully!')
         print("***************************************************************\n")
+        return True
     except ClientError as error:
         logging.error(error)
         print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         print(error)
         print(f'Could not upload {filename}.')
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+        return False
 
 def check_bucket():
     """Check if there is a bucket """ 
-    s3 = boto3.resource('s3')
-    return s3.Bucket(BUCKET_NAME) in s3.buckets.all()
+    def head_bucket():
+        try:
+            get_s3().head_bucket(Bucket=BUCKET_NAME)
+            return True
+        except ClientError:
+            return False
+    return cached_check('bucket', head_bucket)
+
+def check_environment():
+    """ runs the table and bucket checks at the same time """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        tables = executor.submit(check_tables)
+        bucket = executor.submit(check_bucket)
+        return tables.result(), bucket.result()
 
 def create_bucket():
     """Create an S3 bucket in us-east-1"""
     # Create bucket
-    s3 = boto3.resource('s3')
+    _env_checks.pop('bucket', None)
     try:
-        s3.create_bucket(Bucket=BUCKET_NAME)
+        get_s3().create_bucket(Bucket=BUCKET_NAME)
     except ClientError as err:
         logging.error(err)
         print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
@@ -843,17 +1882,88 @@ def create_bucket():
     print(f'Created {BUCKET_NAME} in region {REGION}.')
     print("***************************************************************\n")
 
+# S3 MANIFEST
+MANIFEST_FILE = './NapierHomework4/npc_manifest.json'
+MANIFEST_TTL = 300 # seconds before the manifest is checked against a fresh listing
+PURGE_BATCH_SIZE = 1000 # most keys delete_objects accepts in one request
+PURGE_WORKERS = 8
+PURGE_RETRIES = 3
+_manifest = None
+_manifest_lock = threading.Lock()
+
+def iter_bucket_objects(prefix=''):
+    """ yields every object in the bucket, one 1,000 key listing page at a time """
+    paginator = get_s3().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        yield from page.get('Contents', [])
+
+def load_manifest():
+    """ reads the saved key, size and ETag manifest for the bucket from disk """
+    global _manifest
+    if _manifest is None:
+        _manifest = {'bucket': BUCKET_NAME, 'refreshed_at': 0, 'objects': {}}
+        try:
+            with open(MANIFEST_FILE, encoding='utf-8') as manifest_file:
+                saved = json.load(manifest_file)
+            if saved.get('bucket') == BUCKET_NAME:
+                _manifest = saved
+        except (OSError, ValueError):
+            pass
+    return _manifest
+
+def save_manifest():
+    """ writes the manifest to disk so the next run can skip the listing """
+    if _manifest is None:
+        return
+    with _manifest_lock:
+        try:
+            with open(MANIFEST_FILE, 'w', encoding='utf-8') as manifest_file:
+                json.dump(_manifest, manifest_file)
+        except OSError as error:
+            logging.error(error)
+
+def refresh_manifest(force=False):
+    """ relists the bucket once the manifest is older than MANIFEST_TTL """
+    manifest = load_manifest()
+    if not force and time.time() - manifest['refreshed_at'] < MANIFEST_TTL:
+        return manifest
+    old_objects = manifest['objects']
+    objects = {}
+    changed = 0
+    for obj in iter_bucket_objects():
+        entry = {'size': obj['Size'], 'etag': obj['ETag']}
+        if old_objects.get(obj['Key']) != entry:
+            changed += 1
+        objects[obj['Key']] = entry
+    removed = len(old_objects.keys() - objects.keys())
+    with _manifest_lock:
+        manifest['objects'] = objects
+        manifest['refreshed_at'] = time.time()
+    logging.info('Manifest refreshed: %s objects, %s new or changed, %s removed',
+                 len(objects), changed, removed)
+    save_manifest()
+    return manifest
+
+def manifest_add(key, size, etag=None):
+    """ records an object this program wrote without relisting the bucket """
+    with _manifest_lock:
+        load_manifest()['objects'][key] = {'size': size, 'etag': etag}
+
+def manifest_remove(keys):
+    """ forgets objects this program deleted without relisting the bucket """
+    with _manifest_lock:
+        objects = load_manifest()['objects']
+        for key in keys:
+            objects.pop(key, None)
+
+def get_object_keys():
+    """ sorted keys of every object in the bucket, served from the manifest """
+    return sorted(refresh_manifest()['objects'])
+
 def list_bucket_object_count():
-    """List the objects in an Amazon S3 bucket"""
-    # Retrieve the list of bucket objects
+    """Count the objects in an Amazon S3 bucket"""
     try:
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME)
-        if 'Contents' in response:
-            item_count = 0
-            for item in response:
-                item_count = item_count + 1
-            return item_count
-        return 0
+        return len(refresh_manifest()['objects'])
     except ClientError as err:
         logging.error(err)
         return 0
@@ -862,65 +1972,56 @@ def list_bucket_objects():
     """List the objects in an Amazon S3 bucket"""
     # Retrieve the list of bucket objects
     try:
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME)
-        if 'Contents' in response:
-            item_count = 0
-            for obj in response['Contents']:
-                item_count = item_count + 1
-                item_number = str(item_count)
-                print("[" + item_number + "] " + obj["Key"])
+        object_keys = get_object_keys()
+        if object_keys:
+            for item_number, key in enumerate(object_keys, start=1):
+                print("[" + str(item_number) + "] " + key)
         else: 
             print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
             print('Cannot select an item. Bucket is empty')
             print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+        return object_keys
     except ClientError as err:
         # AllAccessDisabled error == bucket not found
         logging.error(err)
         print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         print('Cannot display bucket items')
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+        return []
 
 def user_object_select():
     """ lets see a list of s3 bucket objects to select one """ 
-    object_count = list_bucket_object_count()
+    # the keys printed are the keys selected from, so the bucket is listed once
+    object_keys = list_bucket_objects()
+    object_count = len(object_keys)
     if object_count > 0:
-        list_bucket_objects()
         while True:
             object_choice = input("Which object would you like to select? ")
             try:
                 validate_choice = int(object_choice)
                 if validate_choice > 0 and validate_choice <= object_count:
-                    try:
-                        resp = s3.list_objects_v2(Bucket=BUCKET_NAME)
-                        count = 0
-                        for item in resp['Contents']:
-                            count = count + 1
-                            if count == int(object_choice):
-                                object_name = item['Key']
-                                print("You selected: " + object_name)
-                        return object_name
-                    except ClientError as e:
-                        logging.error(e)
-                        print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-                        print(f'Could not select an object from {BUCKET_NAME}')
-                        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
-                else:
-                    print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-                    print('Invalid input. Number entered is out of expected range.')
-                    print('Please enter the number that corresponds to the object.')
-                    print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
-            except:
+                    object_name = object_keys[validate_choice - 1]
+                    print("You selected: " + object_name)
+                    return object_name
+                print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+                print('Invalid input. Number entered is out of expected range.')
+                print('Please enter the number that corresponds to the object.')
+                print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+            except ValueError:
                 print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
                 print('Invalid Input. Value should be digits.')
                 print('Please enter the number that corresponds to the object.')
                 print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+    return None
 
 def delete_object():
     """Delete an object from an S3 bucket"""
     object_name = user_object_select()
     if object_name: 
         try:
-            s3.delete_object(Bucket=BUCKET_NAME, Key=object_name)
+            get_s3().delete_object(Bucket=BUCKET_NAME, Key=object_name)
+            manifest_remove([object_name])
+            delete_character_records([object_name])
             logging.info(f'Deleted {object_name} from {BUCKET_NAME}.')
             print("\n*************************** SUCCESS ***************************")
             print(f'Deleted {object_name} \nfrom {BUCKET_NAME} successfully!')
@@ -935,25 +2036,82 @@ def delete_object():
     print(f'Attempt to delete an item from {BUCKET_NAME} failed. Bucket is empty.')
     print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
 
+def delete_key_batch(keys):
+    """ deletes up to 1,000 keys in one request, retrying the keys S3 reports as failed """
+    remaining = keys
+    for attempt in range(PURGE_RETRIES):
+        response = get_s3().delete_objects(
+            Bucket=BUCKET_NAME,
+            Delete={"Objects": [{"Key": key} for key in remaining], "Quiet": True}
+        )
+        errors = response.get('Errors', [])
+        for error in errors:
+            logging.error('Could not delete %s: %s %s', error['Key'], error['Code'],
+                          error['Message'])
+        remaining = [error['Key'] for error in errors]
+        if not remaining:
+            break
+        time.sleep(0.1 * 2 ** attempt)
+    failed = set(remaining)
+    deleted = [key for key in keys if key not in failed]
+    manifest_remove(deleted)
+    delete_character_records(deleted)
+    return len(deleted), remaining
+
 def empty_bucket():
     """Remove all objects from a bucket."""
+    start = time.perf_counter()
+    deleted = 0
+    failed = []
+    pending = set()
+
+    def collect(done):
+        nonlocal deleted
+        for future in done:
+            pending.discard(future)
+            batch_deleted, batch_failed = future.result()
+            deleted += batch_deleted
+            failed.extend(batch_failed)
+            rate = deleted / max(time.perf_counter() - start, 0.001)
+            print(f'*  {deleted} characters deleted ({rate:.0f}/sec)...')
+
     try:
-        # First we list all files in folder
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME)
-        files_in_folder = response["Contents"]
-        files_to_delete = []
-        # We will create Key array to pass to delete_objects function
-        for f in files_in_folder:
-            files_to_delete.append({"Key": f["Key"]})
-        # This will delete all files in a folder
-        response = s3.delete_objects(
-            Bucket=BUCKET_NAME, Delete={"Objects": files_to_delete}
-        )
+        with ThreadPoolExecutor(max_workers=PURGE_WORKERS) as executor:
+            batch = []
+            # the listing is paged while earlier pages are being deleted
+            for obj in iter_bucket_objects():
+                batch.append(obj['Key'])
+                if len(batch) == PURGE_BATCH_SIZE:
+                    if len(pending) >= PURGE_WORKERS:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    pending.add(executor.submit(delete_key_batch, batch))
+                    batch = []
+            if batch:
+                pending.add(executor.submit(delete_key_batch, batch))
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
     except ClientError as error:
         logging.error(error)
         print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         print('Unable to empty bucket. Please see log for more info.')
         print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+        return
+    seconds = time.perf_counter() - start
+    logging.info('Deleted %s objects from %s in %.2fs, %s failed',
+                 deleted, BUCKET_NAME, seconds, len(failed))
+    if failed:
+        print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        print(f'{len(failed)} characters could not be deleted. Please see log for more info.')
+        print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
+    elif deleted == 0:
+        print(f'{BUCKET_NAME} is already empty.')
+    else:
+        print("\n*************************** SUCCESS ***************************")
+        print(f'Deleted {deleted} characters from {BUCKET_NAME} in {seconds:.2f}s')
+        print("***************************************************************\n")
+    save_manifest()
 
 def download_object():
     # Download an object from a S3 Bucket
@@ -963,7 +2121,8 @@ def download_object():
         try:
             object_name = user_object_select()
             local_object_name = "download_" + object_name
-            s3.download_file(BUCKET_NAME, object_name, local_object_name)
+            get_s3().download_file(BUCKET_NAME, object_name, local_object_name,
+                                   Config=get_transfer_config())
             logging.info(f'{object_name} was downloaded from {BUCKET_NAME}')
             print("\n*************************** SUCCESS ***************************")
             print(f'{object_name} was downloaded \nfrom {BUCKET_NAME} successfully!')
@@ -979,6 +2138,203 @@ def download_object():
     print(f'Attempt to copy an object from {BUCKET_NAME} failed. Bucket is empty.')
     print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
 
+# TRANSFER MANAGER
+TRANSFER_WORKERS = 16 # files moved at the same time
+TRANSFER_PART_SIZE = 8 * 1024 * 1024 # files larger than this go up and down in parts
+TRANSFER_PART_CONCURRENCY = 4 # parts of one file moved at the same time
+_transfer_config = None
+
+def get_transfer_config():
+    """ the shared multipart settings for every upload and download """
+    global _transfer_config
+    if _transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+        _transfer_config = TransferConfig(multipart_threshold=TRANSFER_PART_SIZE,
+                                          multipart_chunksize=TRANSFER_PART_SIZE,
+                                          max_concurrency=TRANSFER_PART_CONCURRENCY)
+    return _transfer_config
+
+def file_sha256(path):
+    """ hex SHA-256 of a local file """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def checksum_args(sha256):
+    """ upload arguments that have S3 check a SHA-256 and keep it with the object """
+    # S3 rejects the upload if the body does not match, and multipart objects only get a
+    # checksum of their parts, so the whole-file digest is also kept in the metadata
+    return {'ChecksumAlgorithm': 'SHA256', 'Metadata': {'sha256': sha256}}
+
+def object_sha256(key):
+    """ hex SHA-256 S3 holds for an object, or None if it was saved without one """
+    head = get_s3().head_object(Bucket=BUCKET_NAME, Key=key, ChecksumMode='ENABLED')
+    if 'sha256' in head['Metadata']:
+        return head['Metadata']['sha256']
+    # S3's own checksum only covers the whole file when it was not uploaded in parts
+    checksum = head.get('ChecksumSHA256')
+    if checksum and '-' not in checksum and head.get('ChecksumType') != 'COMPOSITE':
+        return base64.b64decode(checksum).hex()
+    return None
+
+def transfer_upload(path, key=None, verify=False):
+    """ uploads one file; when verifying, returns True once S3 holds the same checksum """
+    key = key or os.path.basename(path)
+    sha256 = file_sha256(path) if verify else None
+    get_s3().upload_file(path, BUCKET_NAME, key,
+                         ExtraArgs=checksum_args(sha256) if verify else None,
+                         Config=get_transfer_config())
+    if verify and object_sha256(key) != sha256:
+        raise ValueError(f'Checksum of {key} does not match {path}')
+    manifest_add(key, os.path.getsize(path))
+    return verify
+
+def upload_bytes(data, key):
+    """ uploads bytes held in memory without writing them to disk first """
+    # the digest of bytes already in memory is cheap, so every sheet can be verified later
+    get_s3().upload_fileobj(io.BytesIO(data), BUCKET_NAME, key,
+                            ExtraArgs=checksum_args(hashlib.sha256(data).hexdigest()),
+                            Config=get_transfer_config())
+    manifest_add(key, len(data))
+    return key
+
+def transfer_download(key, path, verify=False):
+    """ downloads one object; when verifying, returns whether it matched a saved checksum """
+    get_s3().download_file(BUCKET_NAME, key, path,
+                           ExtraArgs={'ChecksumMode': 'ENABLED'} if verify else None,
+                           Config=get_transfer_config())
+    if not verify:
+        return False
+    expected = object_sha256(key)
+    if expected is None:
+        logging.warning('%s was saved without a checksum and could not be verified', key)
+        return False
+    if expected != file_sha256(path):
+        raise ValueError(f'Checksum of {path} does not match {key}')
+    return True
+
+def transfer_files(uploads=(), downloads=(), verify=False, workers=TRANSFER_WORKERS):
+    """ moves many files at once: uploads are paths, downloads are (key, path) pairs """
+    start = time.perf_counter()
+    stats = {'uploaded': 0, 'downloaded': 0, 'failed': 0, 'bytes': 0, 'verified': 0,
+             'unverified': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for path in uploads:
+            futures[executor.submit(transfer_upload, path, verify=verify)] = ('uploaded', path)
+        for key, path in downloads:
+            futures[executor.submit(transfer_download, key, path, verify=verify)] = \
+                ('downloaded', path)
+        for future in as_completed(futures):
+            direction, path = futures[future]
+            try:
+                verified = future.result()
+                stats[direction] += 1
+                if verify:
+                    stats['verified' if verified else 'unverified'] += 1
+                stats['bytes'] += os.path.getsize(path)
+            except (ClientError, OSError, ValueError) as error:
+                stats['failed'] += 1
+                logging.error(error)
+    seconds = time.perf_counter() - start
+    rate = stats['bytes'] / max(seconds, 0.001) / (1024 * 1024)
+    logging.info('Transferred %s up, %s down, %s failed in %.2fs (%.1f MB/sec)',
+                 stats['uploaded'], stats['downloaded'], stats['failed'], seconds, rate)
+    print("\n************************ TRANSFER SUMMARY *********************")
+    print(f"*  Uploaded {stats['uploaded']}, downloaded {stats['downloaded']}, "
+          f"failed {stats['failed']}")
+    print(f"*  {seconds:.2f}s at {rate:.1f} MB/sec")
+    if verify:
+        print(f"*  Checksums verified {stats['verified']}, "
+              f"not verified {stats['unverified']} (no checksum saved)")
+    print("***************************************************************\n")
+    return stats
+
+def download_saved_characters(directory, verify=False):
+    """ downloads every saved character into a local directory """
+    os.makedirs(directory, exist_ok=True)
+    downloads = [(key, os.path.join(directory, key)) for key in get_object_keys()]
+    return transfer_files(downloads=downloads, verify=verify)
+
+# BATCH PIPELINE
+PIPELINE_UPLOAD_WORKERS = 8
+PIPELINE_MAX_PENDING = 64 # characters allowed to wait in each stage before generation pauses
+
+def render_character_sheet(character, descriptions, pdf_name):
+    """ Runs in a worker process: renders one character sheet into memory """
+    return pdf_name, pdf_bytes(build_character_pdf(**character, **descriptions))
+
+def upload_character_sheet(pdf_name, data, keep_local=False):
+    """ Runs in an upload thread: the shared S3 client is thread safe """
+    if keep_local:
+        with open(pdf_name, 'wb') as pdf_file:
+            pdf_file.write(data)
+    return upload_bytes(data, pdf_name)
+
+def run_pipeline(n, seed=None, render_workers=None, upload_workers=PIPELINE_UPLOAD_WORKERS,
+                 max_pending=PIPELINE_MAX_PENDING, keep_local=False):
+    """ Generates, renders and uploads n characters with every stage running at once """
+    timestamp = datetime.now().strftime("%d-%m-%y_%H%M")
+    start = time.perf_counter()
+    rendering = set()
+    uploading = set()
+    stats = {'rendered': 0, 'uploaded': 0, 'failed': 0}
+    description_cache = {}
+    # records wait here until their sheet is uploaded, then are written in batches
+    pending_records = {}
+    records = []
+
+    def collect(done):
+        for future in done:
+            error = future.exception()
+            if future in rendering:
+                rendering.discard(future)
+                if error is None:
+                    stats['rendered'] += 1
+                    uploading.add(uploaders.submit(upload_character_sheet, *future.result(),
+                                                   keep_local=keep_local))
+            else:
+                uploading.discard(future)
+                if error is None:
+                    stats['uploaded'] += 1
+                    records.append(pending_records.pop(future.result()))
+                    if len(records) >= CHARACTER_RECORD_BATCH:
+                        save_character_records(records)
+                        records.clear()
+                    if stats['uploaded'] % 100 == 0:
+                        print(f"*  {stats['uploaded']} of {n} characters saved...")
+            if error is not None:
+                stats['failed'] += 1
+                logging.error(error)
+
+    with ProcessPoolExecutor(max_workers=render_workers) as renderers, \
+            ThreadPoolExecutor(max_workers=upload_workers) as uploaders:
+        for number, character in enumerate(generate_characters(n, seed=seed), start=1):
+            # backpressure: stop generating while either stage is full
+            while len(rendering) >= max_pending or len(uploading) >= max_pending:
+                done, _ = wait(rendering | uploading, return_when=FIRST_COMPLETED)
+                collect(done)
+            descriptions = resolve_descriptions([character], description_cache)[0]
+            pdf_name = character_pdf_name(character['name'], timestamp, number)
+            pending_records[pdf_name] = character_record(character, pdf_name)
+            rendering.add(renderers.submit(render_character_sheet, character, descriptions,
+                                           pdf_name))
+        while rendering or uploading:
+            done, _ = wait(rendering | uploading, return_when=FIRST_COMPLETED)
+            collect(done)
+    save_character_records(records)
+    seconds = time.perf_counter() - start
+    rate = stats['uploaded'] / max(seconds, 0.001)
+    logging.info('Pipeline saved %s characters in %.2fs (%.0f/sec), %s failed',
+                 stats['uploaded'], seconds, rate, stats['failed'])
+    print("\n*************************** SUCCESS ***************************")
+    print(f"Saved {stats['uploaded']} characters to {BUCKET_NAME}")
+    print(f"in {seconds:.2f}s ({rate:.0f} characters/sec), {stats['failed']} failed")
+    print("***************************************************************\n")
+    return stats
+
 def main_menu():
     """ User Menu """
     print("\n************************** MAIN MENU **************************")
@@ -990,16 +2346,19 @@ def main_menu():
     print("*  [4] Download A Saved Character                             *")
     print("*  [5] Delete A Saved Character                               *")
     print("*  [6] Delete All Saved Characters                            *")
+    print("*  [7] Find Saved Characters                                  *")
     print("*  [0] Exit the program                                       *")
     print("***************************************************************\n")
 
 def main():
     """Character Builder Application"""
     # Check if environment is ready
-    if check_tables() is False:
+    tables_ready, bucket_ready = check_environment()
+    if tables_ready is False:
         print("Please wait while the cloud environment is being prepared...")
-        create_db()
-    if check_bucket() is False:
+        # only the missing or empty tables are set up
+        create_db(unready_tables())
+    if bucket_ready is False:
         print("Please wait while the cloud environment is being prepared...")
         create_bucket()
     # Main Menu
@@ -1015,13 +2374,10 @@ def main():
             if option == 1:
                 try:
                     print("\n************************* PROCESSING *************************")
-                    gender = get_random_gender()
-                    name = get_random_name(gender)
-                    profession = get_random_profession()
-                    class_type = get_random_class()
-                    race = get_random_race()
-                    traits = get_random_traits()
-                    quirk = get_random_quirk()
+                    with timed('random_character'):
+                        character = get_random_character()
+                    gender, name, profession, class_type, race, traits, quirk = (
+                        character[field] for field in CHARACTER_FIELDS)
                     print("***************************************************************")
                     print("\n************************** YOUR NPC ***************************")
                     display_character(gender, name, profession, class_type, race, traits, quirk)
@@ -1072,14 +2428,19 @@ def main():
                 if user_continue_option():
                     empty_bucket()
                 print("***************************************************************\n")
+            if option == 7:
+                print("\n******************** FIND SAVED CHARACTERS ********************")
+                find_saved_characters()
+                print("***************************************************************\n")
             if option == 0:
                 # Exit application
+                save_manifest()
                 print("\n************************** GOOD BYE ***************************")
                 print("*  Thank you for using the NPC Builder application            *")
                 print("***************************************************************\n")
                 sys.exit()
             # Error handling (invalid integer)
-            if option < 0 or option > 6:
+            if option < 0 or option > 7:
                 logging.error("User entered an invalid input at the main menu.")
                 print("\n!!!!!!!!!!!!!!!!!!!!!!!!!!!! ERROR !!!!!!!!!!!!!!!!!!!!!!!!!!!!")
                 print("!  Invalid number entered.                                    !")
@@ -1094,5 +2455,98 @@ def main():
             print("!  Please enter a number corresponding to a menu option.      !")
             print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n")
 
+def parse_args(argv=None):
+    """ Command line options for running without the menu """
+    parser = argparse.ArgumentParser(description='NPC Builder')
+    parser.add_argument('--generate', type=int, metavar='N',
+                        help='write N random characters and exit instead of showing the menu')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl',
+                        help='output format for --generate (default: jsonl)')
+    parser.add_argument('--seed', type=int,
+                        help='random seed for --generate, or for the menu\'s random picks')
+    parser.add_argument('--output', help='file to write characters to (default: stdout)')
+    parser.add_argument('--upload', nargs='+', metavar='FILE',
+                        help='upload character files to the bucket and exit')
+    parser.add_argument('--download-all', metavar='DIR',
+                        help='download every saved character into DIR and exit')
+    parser.add_argument('--verify', action='store_true',
+                        help='checksum files moved by --upload and --download-all')
+    parser.add_argument('--backend', choices=sorted(CATALOG_BACKENDS),
+                        help='where the menu and --generate read the catalogs from '
+                             '(default: NPC_CATALOG_BACKEND or dynamodb)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='render and upload the --generate characters as PDFs instead')
+    parser.add_argument('--roster', metavar='TITLE',
+                        help='save the --generate characters as one roster PDF with this title')
+    parser.add_argument('--no-index', action='store_true',
+                        help='leave the index page out of a --roster PDF')
+    parser.add_argument('--keep-local', action=argparse.BooleanOptionalAction,
+                        help='also write saved PDFs to the working directory (default: on for '
+                             'the menu, off for --pipeline and --roster)')
+    parser.add_argument('--compile-catalogs', action='store_true',
+                        help='compile the DB-Data json files into the binary catalog file '
+                             'read by --backend binary')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write AWS call and step timings to FILE at exit, as Prometheus '
+                             'text for a .prom file and JSON otherwise (or NPC_METRICS_FILE)')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes for generation, or PDF rendering with '
+                             '--pipeline (default: one per core for rendering)')
+    args = parser.parse_args(argv)
+    if args.generate is None and (args.pipeline or args.roster or args.no_index):
+        parser.error('--pipeline/--roster/--no-index require --generate N')
+    return args
+
+def run_cli(args):
+    """ Runs the command line options without the interactive menu """
+    if args.metrics:
+        set_metrics_file(args.metrics)
+    if args.compile_catalogs:
+        path = compile_catalogs()
+        print(f'Compiled the catalogs into {path}', file=sys.stderr)
+        if args.generate is None:
+            return
+    if args.upload or args.download_all:
+        if args.upload:
+            transfer_files(uploads=args.upload, verify=args.verify)
+        if args.download_all:
+            download_saved_characters(args.download_all, verify=args.verify)
+        save_manifest()
+        return
+    if args.roster:
+        characters = generate_characters(args.generate, seed=args.seed, workers=args.workers)
+        save_roster(characters, args.roster, index=not args.no_index,
+                    keep_local=args.keep_local)
+        save_manifest()
+        return
+    if args.pipeline:
+        run_pipeline(args.generate, seed=args.seed, render_workers=args.workers,
+                     keep_local=args.keep_local)
+        save_manifest()
+        return
+    start = time.perf_counter()
+    characters = generate_characters(args.generate, seed=args.seed, workers=args.workers)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as output:
+            count = write_characters(characters, output, args.format)
+    else:
+        count = write_characters(characters, sys.stdout, args.format)
+    seconds = time.perf_counter() - start
+    logging.info('Generated %s characters in %.2fs (%.0f/sec)',
+                 count, seconds, count / max(seconds, 0.001))
+
 if __name__ == '__main__':
-    main()
+    arguments = parse_args()
+    if arguments.metrics:
+        set_metrics_file(arguments.metrics)
+    if arguments.seed is not None:
+        seed_random(arguments.seed)
+    if arguments.backend:
+        set_catalog_backend(arguments.backend)
+    if arguments.keep_local is not None:
+        SAVE_LOCAL_COPY = arguments.keep_local
+    if (arguments.generate is not None or arguments.upload or arguments.download_all
+            or arguments.compile_catalogs):
+        run_cli(arguments)
+    else:
+        main()
@@ -0,0 +1,458 @@
+"""
+NPC Builder tests
+Purpose: Checks npc_builder.py against the json files in DB-Data, and its AWS
+paths against moto's local DynamoDB and S3, so the tests need no AWS account.
+Usage: python -m pytest -q   (or python -m unittest test_npc_builder)
+"""
+import io
+import os
+import sys
+import json
+import hashlib
+import random
+import shutil
+import tempfile
+import unittest
+import contextlib
+from collections import Counter
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(REPO_DIR, 'DB-Data')
+
+# moto answers boto3 calls locally, these keep boto3 from looking for real credentials
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+# npc_builder logs to ./NapierHomework4/npc_builder.log, so import it from a scratch folder
+WORK_DIR = tempfile.mkdtemp(prefix='npc-test-')
+os.makedirs(os.path.join(WORK_DIR, 'NapierHomework4'))
+_cwd = os.getcwd()
+os.chdir(WORK_DIR)
+sys.path.insert(0, REPO_DIR)
+try:
+    import npc_builder as nb
+finally:
+    os.chdir(_cwd)
+
+class CatalogTestCase(unittest.TestCase):
+    """ reads the catalogs from the json files in DB-Data """
+
+    def setUp(self):
+        self.previous_data_dir = nb.DATA_DIR
+        nb.DATA_DIR = DATA_DIR
+        nb.set_catalog_backend(nb.LocalCatalog(DATA_DIR))
+
+    def tearDown(self):
+        nb.DATA_DIR = self.previous_data_dir
+        nb.set_catalog_backend(nb.LocalCatalog(DATA_DIR))
+
+@unittest.skipUnless(mock_aws, 'the AWS tests need moto: pip install "moto[dynamodb,s3]"')
+class AwsTestCase(CatalogTestCase):
+    """ runs against moto's local DynamoDB and S3 with fresh clients for every test """
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp(prefix='npc-test-')
+        self.aws = mock_aws()
+        self.aws.start()
+        nb._clients.clear()
+        nb._env_checks.clear()
+        self.previous_manifest_file = nb.MANIFEST_FILE
+        nb.MANIFEST_FILE = os.path.join(self.work_dir, 'npc_manifest.json')
+        nb._manifest = None
+
+    def tearDown(self):
+        self.aws.stop()
+        nb._clients.clear()
+        nb._env_checks.clear()
+        nb.MANIFEST_FILE = self.previous_manifest_file
+        nb._manifest = None
+        shutil.rmtree(self.work_dir)
+        super().tearDown()
+
+class AliasTableTest(unittest.TestCase):
+
+    def test_draws_follow_weights(self):
+        table = nb.AliasTable(['a', 'b', 'c'], [1, 2, 7])
+        draws = Counter(table.sample(random.Random(1), 20000))
+        self.assertAlmostEqual(draws['a'] / 20000, 0.1, delta=0.02)
+        self.assertAlmostEqual(draws['b'] / 20000, 0.2, delta=0.02)
+        self.assertAlmostEqual(draws['c'] / 20000, 0.7, delta=0.02)
+
+    def test_zero_weight_is_never_drawn(self):
+        table = nb.AliasTable(['a', 'b'], [0, 1])
+        self.assertEqual(set(table.sample(random.Random(1), 1000)), {'b'})
+
+    def test_needs_a_positive_weight(self):
+        with self.assertRaises(ValueError):
+            nb.AliasTable(['a'], [0])
+        with self.assertRaises(ValueError):
+            nb.AliasTable([], [])
+
+class TraitSamplingTest(CatalogTestCase):
+
+    def test_traits_do_not_contradict(self):
+        exclusions = nb.get_trait_exclusions()
+        rng = random.Random(5)
+        for _ in range(500):
+            traits = nb.sample_traits(rng)
+            self.assertEqual(len(set(traits)), nb.TRAITS_PER_CHARACTER)
+            for trait in traits:
+                self.assertFalse(exclusions.get(trait, set()) & set(traits))
+
+    def test_failed_trait_draw_is_raised(self):
+        draws = nb.MAX_TRAIT_DRAWS
+        nb.MAX_TRAIT_DRAWS = 1
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                with self.assertRaises(ValueError):
+                    nb.get_random_traits(random.Random(1))
+        finally:
+            nb.MAX_TRAIT_DRAWS = draws
+        self.assertIn('ERROR', output.getvalue())
+
+class SeedTest(CatalogTestCase):
+
+    def test_seed_repeats_characters(self):
+        first = list(nb.generate_characters(50, seed=7))
+        self.assertEqual(first, list(nb.generate_characters(50, seed=7)))
+        self.assertNotEqual(first, list(nb.generate_characters(50, seed=8)))
+
+    def test_workers_do_not_change_seeded_characters(self):
+        size = nb.GENERATION_BATCH_SIZE * 2 + 10
+        self.assertEqual(list(nb.generate_characters(size, seed=7)),
+                         list(nb.generate_characters(size, seed=7, workers=2)))
+
+    def test_seed_random_repeats_menu_picks(self):
+        nb.seed_random(3)
+        first = [nb.get_random_key('trait') for _ in range(20)]
+        nb.seed_random(3)
+        self.assertEqual(first, [nb.get_random_key('trait') for _ in range(20)])
+
+class BinaryCatalogTest(CatalogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp(prefix='npc-test-')
+        self.path = os.path.join(self.work_dir, 'catalogs.npcc')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+        super().tearDown()
+
+    def test_round_trip_matches_json(self):
+        nb.compile_catalogs(self.path, DATA_DIR)
+        compiled = nb.BinaryCatalog(self.path, DATA_DIR)
+        local = nb.LocalCatalog(DATA_DIR)
+        for table_name in nb.TABLE_NAMES:
+            self.assertEqual(compiled.load_rows(table_name), local.load_rows(table_name))
+
+    def test_refuses_stale_table(self):
+        data_dir = os.path.join(self.work_dir, 'DB-Data')
+        shutil.copytree(DATA_DIR, data_dir)
+        nb.compile_catalogs(self.path, data_dir)
+        with open(os.path.join(data_dir, 'quirk.json'), 'a', encoding='utf-8') as json_file:
+            json_file.write('\n')
+        compiled = nb.BinaryCatalog(self.path, data_dir)
+        compiled.load_rows('race')
+        with self.assertRaises(ValueError):
+            compiled.load_rows('quirk')
+
+class ItemCountTest(AwsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with contextlib.redirect_stdout(io.StringIO()):
+            nb.create_metadata_table()
+            nb.initialize_table('race')
+        self.race_count = len(nb.LocalCatalog(DATA_DIR).load_rows('race'))
+
+    def counter_item(self, table_name):
+        return nb.get_dynamodb_client().get_item(
+            TableName=nb.METADATA_TABLE, Key={'table_name': {'S': table_name}}).get('Item')
+
+    def test_reads_the_counter_instead_of_scanning(self):
+        self.assertEqual(nb.count_items_db('race'), self.race_count)
+        nb.set_item_count('race', 42)
+        self.assertEqual(nb.count_items_db(nb.get_dynamodb().Table('race')), 42)
+
+    def test_missing_counter_is_backfilled_by_one_scan(self):
+        nb.get_dynamodb_client().delete_item(TableName=nb.METADATA_TABLE,
+                                             Key={'table_name': {'S': 'race'}})
+        self.assertIsNone(self.counter_item('race'))
+        self.assertEqual(nb.count_items_db('race'), self.race_count)
+        self.assertEqual(self.counter_item('race')['item_count']['N'], str(self.race_count))
+
+    def test_check_table_needs_records(self):
+        self.assertTrue(nb.check_table('race'))
+        self.assertTrue(nb.check_table(nb.METADATA_TABLE))
+        nb.create_table(nb.get_dynamodb(), 'quirk').wait_until_exists()
+        self.assertFalse(nb.check_table('quirk'))
+        self.assertFalse(nb.check_table('trait'))
+
+class CommandLineTest(unittest.TestCase):
+
+    def assertRejected(self, argv):
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                nb.parse_args(argv)
+
+    def test_pipeline_needs_generate(self):
+        self.assertRejected(['--pipeline'])
+        self.assertTrue(nb.parse_args(['--generate', '5', '--pipeline']).pipeline)
+
+    def test_roster_needs_generate(self):
+        self.assertRejected(['--roster', 'Town'])
+        self.assertRejected(['--no-index'])
+        self.assertEqual(nb.parse_args(['--generate', '5', '--roster', 'Town']).roster, 'Town')
+
+class DiffRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.items = [{'quirk_id': i, 'quirk': f'Quirk {i}'} for i in range(1, 6)]
+        _, _, self.hashes = nb.diff_rows('quirk', self.items, [])
+
+    def renumber(self, items):
+        return [dict(item, quirk_id=i) for i, item in enumerate(items, start=1)]
+
+    def test_unchanged_rows_write_nothing(self):
+        changed, removed, hashes = nb.diff_rows('quirk', self.items, self.hashes)
+        self.assertEqual((changed, list(removed), hashes), ([], [], self.hashes))
+
+    def test_reorder_writes_nothing(self):
+        items = self.renumber(list(reversed(self.items)))
+        changed, removed, _ = nb.diff_rows('quirk', items, self.hashes)
+        self.assertEqual((changed, list(removed)), ([], []))
+
+    def test_insert_writes_one_row(self):
+        items = self.renumber(self.items[:2] + [{'quirk': 'New'}] + self.items[2:])
+        changed, removed, hashes = nb.diff_rows('quirk', items, self.hashes)
+        self.assertEqual(changed, [{'quirk_id': 6, 'quirk': 'New'}])
+        self.assertEqual(list(removed), [])
+        self.assertEqual(hashes[:5], self.hashes)
+
+    def test_remove_moves_last_row_into_the_gap(self):
+        items = self.renumber(self.items[:1] + self.items[2:])
+        changed, removed, hashes = nb.diff_rows('quirk', items, self.hashes)
+        self.assertEqual(changed, [{'quirk_id': 2, 'quirk': 'Quirk 5'}])
+        self.assertEqual(list(removed), [5])
+        self.assertEqual(len(hashes), 4)
+
+    def test_edit_rewrites_that_row(self):
+        items = [dict(item) for item in self.items]
+        items[3]['quirk'] = 'Edited'
+        changed, removed, _ = nb.diff_rows('quirk', items, self.hashes)
+        self.assertEqual(changed, [{'quirk_id': 4, 'quirk': 'Edited'}])
+        self.assertEqual(list(removed), [])
+
+    def test_rows_without_hashes_are_removed_up_to_old_count(self):
+        changed, removed, _ = nb.diff_rows('quirk', self.items[:3], [], old_count=5)
+        self.assertEqual(len(changed), 3)
+        self.assertEqual(list(removed), [4, 5])
+
+class SyncTest(AwsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        nb.DATA_DIR = os.path.join(self.work_dir, 'DB-Data')
+        shutil.copytree(DATA_DIR, nb.DATA_DIR)
+        nb.create_metadata_table()
+        self.sync_version = nb.CATALOG_SYNC_VERSION
+
+    def tearDown(self):
+        nb.CATALOG_SYNC_VERSION = self.sync_version
+        super().tearDown()
+
+    def trim_races(self, count):
+        path = os.path.join(nb.DATA_DIR, 'race.json')
+        with open(path, encoding='utf-8') as json_file:
+            races = json.load(json_file)
+        with open(path, 'w', encoding='utf-8') as json_file:
+            json.dump(races[:-count], json_file)
+        return len(races) - count
+
+    def table_races(self):
+        return sorted(row['race'] for row in nb.DynamoDBCatalog().load_rows('race'))
+
+    def file_races(self):
+        return sorted(row['race'] for row in nb.LocalCatalog().load_rows('race'))
+
+    def sync_races(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            nb.initialize_table('race')
+
+    def test_shrink_after_version_bump_removes_old_rows(self):
+        self.sync_races()
+        remaining = self.trim_races(2)
+        nb.CATALOG_SYNC_VERSION += 1
+        self.sync_races()
+        self.assertEqual(nb.scan_count_items('race'), remaining)
+        self.assertEqual(nb.count_items_db('race'), remaining)
+        self.assertEqual(self.table_races(), self.file_races())
+        remaining = self.trim_races(1)
+        self.sync_races()
+        self.assertEqual(nb.scan_count_items('race'), remaining)
+        self.assertEqual(nb.count_items_db('race'), remaining)
+        self.assertEqual(self.table_races(), self.file_races())
+
+class SaveCharacterTest(AwsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.save_local_copy = nb.SAVE_LOCAL_COPY
+        with contextlib.redirect_stdout(io.StringIO()):
+            nb.create_bucket()
+            nb.create_character_table()
+        self.character = next(nb.generate_characters(1, seed=1))
+
+    def tearDown(self):
+        nb.SAVE_LOCAL_COPY = self.save_local_copy
+        super().tearDown()
+
+    def save(self, **kwargs):
+        """ saves the character from the scratch folder and returns the PDFs left there """
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                nb.save_character(**self.character, **kwargs)
+        finally:
+            os.chdir(cwd)
+        return [name for name in os.listdir(self.work_dir) if name.endswith('.pdf')]
+
+    def uploaded(self):
+        response = nb.get_s3().list_objects_v2(Bucket=nb.BUCKET_NAME)
+        return [item['Key'] for item in response.get('Contents', [])]
+
+    def test_local_copy_follows_save_local_copy(self):
+        nb.SAVE_LOCAL_COPY = False
+        self.assertEqual(self.save(), [])
+        nb.SAVE_LOCAL_COPY = True
+        self.assertEqual(len(self.save()), 1)
+        self.assertEqual(len(self.uploaded()), 1)
+
+    def test_keep_local_argument_overrides_default(self):
+        nb.SAVE_LOCAL_COPY = True
+        self.assertEqual(self.save(keep_local=False), [])
+        self.assertEqual(len(self.uploaded()), 1)
+
+class BucketTestCase(AwsTestCase):
+    """ starts each test with an empty bucket """
+
+    def setUp(self):
+        super().setUp()
+        with contextlib.redirect_stdout(io.StringIO()):
+            nb.create_bucket()
+
+    def fill_bucket(self, count, prefix='sheet'):
+        """ writes count small objects straight to the bucket, bypassing the manifest """
+        keys = [f'{prefix}-{number:05}.pdf' for number in range(count)]
+        for key in keys:
+            nb.get_s3().put_object(Bucket=nb.BUCKET_NAME, Key=key, Body=b'%PDF')
+        return keys
+
+class ChecksumTest(BucketTestCase):
+
+    def test_uploads_store_their_sha256(self):
+        data = b'%PDF character sheet'
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(nb.upload_to_s3('sheet.pdf', data))
+        self.assertEqual(nb.object_sha256('sheet.pdf'), hashlib.sha256(data).hexdigest())
+
+class ListingTest(BucketTestCase):
+
+    def test_lists_past_one_page(self):
+        keys = self.fill_bucket(1205)
+        self.assertEqual(nb.list_bucket_object_count(), 1205)
+        self.assertEqual(nb.get_object_keys(), keys)
+        self.assertEqual(sum(1 for _ in nb.iter_bucket_objects()), 1205)
+
+    def test_empty_bucket_lists_nothing(self):
+        self.assertEqual(nb.list_bucket_object_count(), 0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(nb.list_bucket_objects(), [])
+
+    def test_manifest_is_saved_and_refreshed(self):
+        keys = self.fill_bucket(3)
+        self.assertEqual(nb.get_object_keys(), keys)
+        nb._manifest = None
+        nb.get_s3().delete_object(Bucket=nb.BUCKET_NAME, Key=keys[0])
+        # a fresh manifest on disk is trusted until MANIFEST_TTL runs out
+        self.assertEqual(nb.get_object_keys(), keys)
+        self.assertEqual(sorted(nb.refresh_manifest(force=True)['objects']), keys[1:])
+
+class PurgeTest(BucketTestCase):
+
+    def setUp(self):
+        super().setUp()
+        nb.create_character_table()
+
+    def purge(self):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            nb.empty_bucket()
+        return output.getvalue()
+
+    def test_purges_past_one_batch(self):
+        self.fill_bucket(1050)
+        self.assertEqual(nb.list_bucket_object_count(), 1050)
+        self.assertIn('Deleted 1050 characters', self.purge())
+        self.assertEqual(list(nb.iter_bucket_objects()), [])
+        self.assertEqual(nb.get_object_keys(), [])
+
+    def test_empty_bucket_is_reported(self):
+        self.assertIn('already empty', self.purge())
+
+class CharacterRecordTest(BucketTestCase):
+
+    def setUp(self):
+        super().setUp()
+        nb.create_character_table()
+        self.characters = {f'npc-{number:03}.pdf': character for number, character in
+                           enumerate(nb.generate_characters(60, seed=2))}
+        nb.save_character_records([nb.character_record(character, key)
+                                   for key, character in self.characters.items()])
+
+    def expected(self, **wanted):
+        return sorted(key for key, character in self.characters.items()
+                      if all(character[field] == value for field, value in wanted.items()))
+
+    def found(self, **wanted):
+        return [record['character_id'] for record in nb.find_characters(**wanted)]
+
+    def test_find_by_one_or_more_attributes(self):
+        first = self.characters['npc-000.pdf']
+        self.assertEqual(self.found(), sorted(self.characters))
+        self.assertEqual(self.found(race=first['race']), self.expected(race=first['race']))
+        self.assertEqual(self.found(profession=first['profession']),
+                         self.expected(profession=first['profession']))
+        wanted = {'race': first['race'], 'class_type': first['class_type'],
+                  'profession': first['profession']}
+        self.assertEqual(self.found(**wanted), self.expected(**wanted))
+        self.assertIn('npc-000.pdf', self.found(**wanted))
+        self.assertEqual(self.found(race='No such race'), [])
+
+    def test_records_keep_the_character(self):
+        record = nb.find_characters(race=self.characters['npc-000.pdf']['race'])[0]
+        character = self.characters[record['character_id']]
+        self.assertEqual({field: record[field] for field in nb.CHARACTER_FIELDS}, character)
+
+    def test_delete_records(self):
+        keys = sorted(self.characters)
+        nb.delete_character_records(keys[:30])
+        self.assertEqual(self.found(), keys[30:])
+
+    def test_purge_deletes_records(self):
+        for key in self.characters:
+            nb.get_s3().put_object(Bucket=nb.BUCKET_NAME, Key=key, Body=b'%PDF')
+        with contextlib.redirect_stdout(io.StringIO()):
+            nb.empty_bucket()
+        self.assertEqual(self.found(), [])
+
+if __name__ == '__main__':
+    unittest.main()